@@ -3,12 +3,20 @@ import json
 import logging
 import os
 import subprocess
+import sys
 import tempfile
 
 from kube_pico_cd.config import settings
-from kube_pico_cd.deployer import push_to_deploy_queue
+from kube_pico_cd.deployer import (
+    concatenate_yamls,
+    fetch_schemas,
+    push_overlays_to_deploy_queue,
+    push_to_deploy_queue,
+)
 from kube_pico_cd.listener import Listener
 from kube_pico_cd.manifest_generator import generate_manifest
+from kube_pico_cd.overlays import OverlayRenderer, load_overlays
+from kube_pico_cd.plan import ERROR, format_plan
 
 _logger = logging.getLogger(__name__)
 
@@ -26,7 +34,56 @@ def deploy(args):
     _logger.info(f"Deploy")
     manifests_root = args.manifests_root
 
-    push_to_deploy_queue(args.deploy_queue_name, manifests_root=manifests_root)
+    if args.kubernetes_version is not None:
+        settings.kubernetes_version = args.kubernetes_version
+
+    validate = False if args.skip_validation else None
+    if args.overlays_root is not None:
+        push_overlays_to_deploy_queue(
+            args.overlays_root,
+            environments=args.environment,
+            deploy_queue_name=args.deploy_queue_name,
+            manifests_root=manifests_root,
+            validate=validate,
+            crd_paths=args.crd_schemas,
+        )
+        return
+
+    push_to_deploy_queue(
+        args.deploy_queue_name,
+        manifests_root=manifests_root,
+        validate=validate,
+        crd_paths=args.crd_schemas,
+    )
+
+
+def do_fetch_schemas(args):
+    _logger.info(f"Fetch schemas")
+    if args.kubernetes_version is not None:
+        settings.kubernetes_version = args.kubernetes_version
+    fetch_schemas(args.manifests_root, crd_paths=args.crd_schemas)
+
+
+def plan(args):
+    _logger.info(f"Plan")
+    if args.namespace is not None:
+        settings.kube_namespace = args.namespace
+    if "kube_namespace" not in settings:
+        raise Exception(
+            "kube_namespace is neither given as argument, nor set in settings, and cannot be determined from the service account"
+        )
+    manifests_root = args.manifests_root or "."
+
+    if args.overlays_root is not None:
+        overlay = load_overlays(args.overlays_root, [args.environment])[0]
+        manifests = OverlayRenderer(manifests_root).render(overlay)[0]
+    else:
+        manifests = concatenate_yamls(manifests_root)
+
+    entries = Listener(settings).plan_manifests(manifests)
+    print(format_plan(entries))
+    if any(entry.action == ERROR for entry in entries):
+        sys.exit(1)
 
 
 def do_generate_manifest(args):
@@ -72,9 +129,81 @@ def main():
     parser_deploy.add_argument(
         "--manifests_root", default=None, help="Manifests root directory (optional)"
     )
+    parser_deploy.add_argument(
+        "--overlays_root",
+        default=None,
+        help="Directory with one overlay directory per environment; manifests_root is then the base tree (optional)",
+    )
+    parser_deploy.add_argument(
+        "--environment",
+        action="append",
+        default=None,
+        help="Environment (overlay directory) to deploy, defaults to all (optional, repeatable)",
+    )
+    parser_deploy.add_argument(
+        "--skip_validation",
+        action="store_true",
+        help="Do not validate the manifests against the OpenAPI schemas before pushing",
+    )
+    parser_deploy.add_argument(
+        "--crd_schemas",
+        action="append",
+        default=None,
+        help="CRD file or directory to load additional schemas from (optional, repeatable)",
+    )
+    parser_deploy.add_argument(
+        "--kubernetes_version",
+        default=None,
+        help="Kubernetes version of the schemas to validate against, e.g. v1.29.0 (optional)",
+    )
 
     parser_deploy.set_defaults(func=deploy)
 
+    parser_plan = subparsers.add_parser(
+        "plan",
+        help="Show what applying the manifests would change, using server-side dry-run",
+    )
+    parser_plan.add_argument(
+        "--manifests_root", default=None, help="Manifests root directory (optional)"
+    )
+    parser_plan.add_argument(
+        "--namespace",
+        type=str,
+        default=None,
+        help="Kubernetes namespace (optional)",
+    )
+    parser_plan.add_argument(
+        "--overlays_root",
+        default=None,
+        help="Directory with one overlay directory per environment (optional)",
+    )
+    parser_plan.add_argument(
+        "--environment",
+        default=None,
+        help="Environment to plan, required with --overlays_root",
+    )
+    parser_plan.set_defaults(func=plan)
+
+    parser_fetch_schemas = subparsers.add_parser(
+        "fetch_schemas",
+        help="Fill the schema cache for the manifests, so that deploy validates offline",
+    )
+    parser_fetch_schemas.add_argument(
+        "--manifests_root", default=None, help="Manifests root directory (optional)"
+    )
+    parser_fetch_schemas.add_argument(
+        "--crd_schemas",
+        action="append",
+        default=None,
+        help="CRD file or directory to load additional schemas from (optional, repeatable)",
+    )
+    parser_fetch_schemas.add_argument(
+        "--kubernetes_version",
+        default=None,
+        help="Kubernetes version of the schemas to fetch, e.g. v1.29.0 (optional)",
+    )
+    parser_fetch_schemas.set_defaults(func=do_fetch_schemas)
+
     parser_manifest = subparsers.add_parser(
         "generate_manifest",
         help="Generate a manifest file",
@@ -90,6 +219,8 @@ def main():
     parser_manifest.set_defaults(func=do_generate_manifest)
 
     args = parser.parse_args()
+    if args.func is plan and args.overlays_root and not args.environment:
+        parser_plan.error("--environment is required with --overlays_root")
     args.func(args)
 
 
@@ -1,12 +1,17 @@
+import hashlib
 import json
 import logging
 import os
+import tempfile
 import time
 from pathlib import Path
 
-import boto3
 import yaml
 from kube_pico_cd.config import settings
+from kube_pico_cd.manifests import parse_documents
+from kube_pico_cd.overlays import OverlayRenderer, load_overlays
+from kube_pico_cd.transport import create_transport
+from kube_pico_cd.validation import SchemaValidator
 
 _logger = logging.getLogger(__name__)
 
@@ -16,7 +21,7 @@ def concatenate_yamls(manifests_root):
     concatenated_yaml = ""
 
     paths = []
-    for path in Path(manifests_root).rglob("*.yaml"):
+    for path in sorted(Path(manifests_root).rglob("*.yaml")):
         with open(path, "r") as file:
             concatenated_yaml += file.read() + "\n---\n"
 
@@ -41,10 +46,36 @@ def create_config_map(build_info):
     return yaml.dump(config_map)
 
 
-def push_to_deploy_queue(deploy_queue_name=None, manifests_root=None):
-    if manifests_root is None:
-        manifests_root = "."
+# Function to validate manifests against the cached OpenAPI schemas
+def validate_manifests(manifests, crd_paths=None, validator=None):
+    documents = parse_documents(manifests)
+    if validator is None:
+        validator = SchemaValidator(settings, crd_paths=crd_paths)
+    errors = validator.validate(documents)
+    if errors:
+        error_list = "\n".join(errors)
+        raise Exception(
+            f"Manifest validation failed with {len(errors)} errors:\n{error_list}"
+        )
+
+
+# Function to fill the schema cache with the schemas of all documents of a
+# manifests tree, so that later validations work offline
+def fetch_schemas(manifests_root=None, crd_paths=None):
+    documents = parse_documents(concatenate_yamls(manifests_root or "."))
+    validator = SchemaValidator(settings, crd_paths=crd_paths)
+    with tempfile.TemporaryDirectory(prefix="kube-pico-cd-crds-") as crd_dir:
+        crd_schemas = validator.register_crds(
+            validator.load_crd_files() + documents, crd_dir
+        )
+        schema_paths, fetch_errors = validator.resolve_schemas(documents, crd_schemas)
+    if fetch_errors:
+        error_list = "\n".join(sorted(fetch_errors.values()))
+        raise Exception(f"Failed to fetch {len(fetch_errors)} schemas:\n{error_list}")
+    _logger.info(f"{len(schema_paths)} schemas cached in {validator.cache_dir}")
+
 
+def get_deploy_queue_name(deploy_queue_name=None):
     if deploy_queue_name is None:
         if "deploy_queue_name" in settings:
             deploy_queue_name = settings.deploy_queue_name
@@ -54,9 +85,12 @@ def push_to_deploy_queue(deploy_queue_name=None, manifests_root=None):
         raise Exception(
             "deploy_queue_name is neither given as argument nor set in settings"
         )
+    return deploy_queue_name
 
-    concatenated_yaml = concatenate_yamls(manifests_root)
 
+# Function to create the message of a build: the build info, and the
+# manifests followed by the build info ConfigMap
+def create_deploy_message(concatenated_yaml):
     build_time_stamp = os.getenv("BUILD_TIMESTAMP", str(int(time.time())))
 
     build_info = {
@@ -67,26 +101,101 @@ def push_to_deploy_queue(deploy_queue_name=None, manifests_root=None):
         "REF_NAME": os.getenv("REF_NAME", "undefined"),
         "BUILD_NUMBER": os.getenv("BUILD_NUMBER", "undefined"),
         "CONFIG_MAP_NAME": settings.config_map_name,
+        "MANIFESTS_SHA256": hashlib.sha256(concatenated_yaml.encode()).hexdigest(),
     }
 
     config_map_yaml = create_config_map(build_info)
     _logger.info(f"ConfigMap YAML:\n{config_map_yaml}")
     full_yaml = concatenated_yaml + config_map_yaml
 
-    message_body = {"data": build_info, "manifests": full_yaml}
+    return {"data": build_info, "manifests": full_yaml}
 
-    sqs = boto3.resource("sqs")
-    _logger.info(f"KUBE_PICO_CD_DEPLOY_QUEUE_NAME: {deploy_queue_name}")
-
-    if deploy_queue_name is None or deploy_queue_name == "":
-        raise Exception(
-            "KUBE_PICO_CD_DEPLOY_QUEUE_NAME environment variable is not set"
-        )
 
-    deploy_queue = sqs.get_queue_by_name(QueueName=deploy_queue_name)
+def send_deploy_message(deploy_queue_name, message_body):
+    _logger.info(f"KUBE_PICO_CD_DEPLOY_QUEUE_NAME: {deploy_queue_name}")
+    transport = create_transport(settings, deploy_queue_name)
 
     message_body_text = json.dumps(message_body)
-    deploy_queue.send_message(MessageBody=message_body_text)
+    transport.send(message_body_text)
     _logger.info(
-        f"Sent message for build {build_info['buildTimestamp']} to queue {deploy_queue_name}"
+        f"Sent message for build {message_body['data']['buildTimestamp']} to queue {deploy_queue_name}"
     )
+
+
+def push_to_deploy_queue(
+    deploy_queue_name=None,
+    manifests_root=None,
+    validate=None,
+    crd_paths=None,
+    manifests=None,
+):
+    if manifests_root is None:
+        manifests_root = "."
+
+    deploy_queue_name = get_deploy_queue_name(deploy_queue_name)
+
+    if manifests is None:
+        concatenated_yaml = concatenate_yamls(manifests_root)
+    else:
+        concatenated_yaml = manifests
+
+    message_body = create_deploy_message(concatenated_yaml)
+
+    if validate is None:
+        validate = settings.get("validate_manifests", True)
+    if validate:
+        validate_manifests(message_body["manifests"], crd_paths=crd_paths)
+
+    send_deploy_message(deploy_queue_name, message_body)
+
+
+# Function to render a base tree with the overlays of several environments
+# and push each rendering to the queue of its environment
+def push_overlays_to_deploy_queue(
+    overlays_root,
+    environments=None,
+    deploy_queue_name=None,
+    manifests_root=None,
+    validate=None,
+    crd_paths=None,
+):
+    if manifests_root is None:
+        manifests_root = "."
+
+    overlays = load_overlays(overlays_root, environments)
+    if len(overlays) == 0:
+        raise Exception(f"No overlays found in {overlays_root}")
+
+    # Render and validate all environments before pushing any of them, so
+    # that an error in one environment does not leave the others half deployed
+    renderer = OverlayRenderer(manifests_root)
+    messages = []
+    for overlay in overlays:
+        queue_name = get_deploy_queue_name(
+            overlay.deploy_queue_name or deploy_queue_name
+        )
+        messages.append(
+            (overlay, queue_name, create_deploy_message(renderer.render(overlay)[0]))
+        )
+
+    # Builds of different environments on one queue would supersede each other
+    environments_by_queue = {}
+    for overlay, queue_name, _ in messages:
+        environments_by_queue.setdefault(queue_name, []).append(overlay.name)
+    for queue_name, names in environments_by_queue.items():
+        if len(names) > 1:
+            raise Exception(
+                f"Environments {', '.join(names)} would be deployed to the same queue {queue_name}, set deploy_queue_name in their overlay.yaml"
+            )
+
+    if validate is None:
+        validate = settings.get("validate_manifests", True)
+    if validate:
+        validator = SchemaValidator(settings, crd_paths=crd_paths)
+        for overlay, _, message_body in messages:
+            _logger.info(f"Validating environment {overlay.name}")
+            validate_manifests(message_body["manifests"], validator=validator)
+
+    for overlay, queue_name, message_body in messages:
+        _logger.info(f"Deploying environment {overlay.name}")
+        send_deploy_message(queue_name, message_body)
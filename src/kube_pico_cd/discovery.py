@@ -0,0 +1,125 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from kube_pico_cd.manifests import document_key
+from kubernetes.dynamic import DynamicClient
+
+_logger = logging.getLogger(__name__)
+
+
+# Messages of kubectl when a kind cannot be mapped to a REST endpoint, which
+# may be caused by a stale discovery cache
+UNKNOWN_KIND_ERRORS = (
+    "no matches for kind",
+    "resource mapping not found",
+    "ensure CRDs are installed first",
+    "the server doesn't have a resource type",
+    "the server could not find the requested resource",
+)
+
+
+def is_unknown_kind_error(stderr):
+    return any(error in stderr for error in UNKNOWN_KIND_ERRORS)
+
+
+# Function to check whether the CustomResourceDefinitions of a bundle differ
+# from the previously applied ones
+def crds_changed(previous_documents, documents):
+    def crds(docs):
+        return {
+            document_key(d): d
+            for d in docs or []
+            if d.get("kind") == "CustomResourceDefinition"
+        }
+
+    current = crds(documents)
+    if previous_documents is None:
+        return bool(current)
+    return crds(previous_documents) != current
+
+
+# API discovery cache shared by all kubectl processes and the dynamic client.
+# It lives in kube_cache_dir, which can be put on a persistent volume to keep
+# it across restarts. kubectl uses a generation subdirectory; invalidating
+# switches to a fresh generation, so that running kubectl processes keep a
+# consistent cache directory. Older generations are removed on the next
+# invalidation.
+class DiscoveryCache:
+    GENERATION_PREFIX = "generation-"
+
+    def __init__(self, settings):
+        self.root_dir = settings.get("kube_cache_dir", "/tmp/kube-pico-cd/cache")
+        self.lock = threading.Lock()
+        self.invalidated_at = 0.0
+        self.dynamic_client = None
+        os.makedirs(self.root_dir, exist_ok=True)
+        generations = self.generations()
+        self.generation = generations[-1] if generations else 0
+        self.cache_dir = self.generation_dir(self.generation)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def generation_dir(self, generation):
+        return os.path.join(self.root_dir, f"{self.GENERATION_PREFIX}{generation}")
+
+    def generations(self):
+        generations = []
+        for entry in os.listdir(self.root_dir):
+            suffix = entry[len(self.GENERATION_PREFIX) :]
+            if entry.startswith(self.GENERATION_PREFIX) and suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    def kubectl_args(self):
+        return [f"--cache-dir={self.cache_dir}"]
+
+    def dynamic_cache_file(self):
+        return os.path.join(self.root_dir, "dynamic-discovery.json")
+
+    def get_dynamic_client(self, api_client):
+        if self.dynamic_client is None:
+            self.dynamic_client = DynamicClient(
+                api_client, cache_file=self.dynamic_cache_file()
+            )
+        return self.dynamic_client
+
+    # Function to fill the cache ahead of the first apply
+    def warm(self):
+        start_time = time.monotonic()
+        completed = subprocess.run(
+            ["kubectl", "api-resources", "-o", "name"] + self.kubectl_args(),
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode == 0:
+            _logger.info(
+                f"Warmed discovery cache in {self.cache_dir} in {time.monotonic() - start_time:.2f}s"
+            )
+        else:
+            _logger.warning(
+                f"Failed to warm discovery cache: {completed.stderr.strip()}"
+            )
+
+    # Function to drop the cache. If since is given, the cache is only dropped
+    # if it has not been dropped after that (monotonic) time already, so that
+    # concurrent failures trigger a single invalidation.
+    def invalidate(self, reason, since=None):
+        with self.lock:
+            if since is not None and self.invalidated_at >= since:
+                return
+            _logger.info(f"Invalidating discovery cache: {reason}")
+            # Processes started before the previous invalidation are done by
+            # now, the generation they used can go
+            for generation in self.generations():
+                if generation < self.generation:
+                    shutil.rmtree(self.generation_dir(generation), ignore_errors=True)
+            self.generation += 1
+            cache_dir = self.generation_dir(self.generation)
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_dir = cache_dir
+            if self.dynamic_client is not None:
+                self.dynamic_client.resources.invalidate_cache()
+            self.invalidated_at = time.monotonic()
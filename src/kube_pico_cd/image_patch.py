@@ -0,0 +1,119 @@
+import copy
+import logging
+
+from kube_pico_cd.manifests import (
+    describe_document,
+    document_key,
+    is_build_info_config_map,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+# Workload kinds whose container images can be patched in place, and the name
+# of the AppsV1Api method that patches them
+PATCHABLE_KINDS = {
+    "Deployment": "patch_namespaced_deployment",
+    "StatefulSet": "patch_namespaced_stateful_set",
+    "DaemonSet": "patch_namespaced_daemon_set",
+}
+
+CONTAINER_LISTS = ("initContainers", "containers")
+
+# The client picks a JSON patch content type for dict bodies, so the strategic
+# merge patch content type is always passed explicitly
+STRATEGIC_MERGE_PATCH = "application/strategic-merge-patch+json"
+
+
+def _pod_spec(document):
+    return ((document.get("spec") or {}).get("template") or {}).get("spec") or {}
+
+
+def _without_images(document):
+    stripped = copy.deepcopy(document)
+    pod_spec = _pod_spec(stripped)
+    for container_list in CONTAINER_LISTS:
+        for container in pod_spec.get(container_list) or []:
+            container.pop("image", None)
+    return stripped
+
+
+def _changed_containers(previous, document):
+    previous_images = {}
+    previous_spec = _pod_spec(previous)
+    for container_list in CONTAINER_LISTS:
+        for container in previous_spec.get(container_list) or []:
+            previous_images[(container_list, container.get("name"))] = container.get(
+                "image"
+            )
+
+    changed = {}
+    pod_spec = _pod_spec(document)
+    for container_list in CONTAINER_LISTS:
+        for container in pod_spec.get(container_list) or []:
+            name = container.get("name")
+            if previous_images.get((container_list, name)) != container.get("image"):
+                changed.setdefault(container_list, []).append(
+                    {"name": name, "image": container.get("image")}
+                )
+    return changed
+
+
+# Function to check whether a bundle differs from the previously applied one
+# only in container images of workloads and in the build info ConfigMap.
+# Returns the list of (document, changed containers) to patch, or None if a
+# full apply is required.
+def find_image_only_changes(previous_documents, documents, config_map_name):
+    previous_by_key = {document_key(d): d for d in previous_documents}
+    documents_by_key = {document_key(d): d for d in documents}
+    if previous_by_key.keys() != documents_by_key.keys():
+        _logger.info("Set of objects changed, image-only fast path not applicable")
+        return None
+
+    changes = []
+    for key, document in documents_by_key.items():
+        previous = previous_by_key[key]
+        if document == previous or is_build_info_config_map(document, config_map_name):
+            continue
+        if document.get("kind") not in PATCHABLE_KINDS or _without_images(
+            document
+        ) != _without_images(previous):
+            _logger.info(
+                f"{describe_document(document)} changed beyond container images, image-only fast path not applicable"
+            )
+            return None
+        changes.append((document, _changed_containers(previous, document)))
+    return changes
+
+
+# Function to patch the container images of workloads with strategic merge
+# patches, containers are merged by name
+def patch_images(
+    apps_api, changes, default_namespace, field_manager=None, governor=None
+):
+    for document, containers in changes:
+        metadata = document["metadata"]
+        namespace = metadata.get("namespace", default_namespace)
+        patch = {"spec": {"template": {"spec": containers}}}
+        _logger.info(
+            f"Patching images of {describe_document(document)} in namespace {namespace}: {containers}"
+        )
+        patch_method = getattr(apps_api, PATCHABLE_KINDS[document["kind"]])
+        if governor is None:
+            patch_method(
+                metadata["name"],
+                namespace,
+                patch,
+                field_manager=field_manager,
+                _content_type=STRATEGIC_MERGE_PATCH,
+            )
+        else:
+            governor.call(
+                document["kind"],
+                patch_method,
+                metadata["name"],
+                namespace,
+                patch,
+                field_manager=field_manager,
+                _content_type=STRATEGIC_MERGE_PATCH,
+            )
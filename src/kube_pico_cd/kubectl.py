@@ -0,0 +1,227 @@
+import logging
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from kube_pico_cd.discovery import is_unknown_kind_error
+from kube_pico_cd.manifests import (
+    chunk_documents,
+    describe_document,
+    dump_documents,
+    is_build_info_config_map,
+)
+from kube_pico_cd.rate_limit import Throttled, is_throttled_error
+
+_logger = logging.getLogger(__name__)
+
+
+class ApplyError(Exception):
+    def __init__(self, message, results=None):
+        super().__init__(message)
+        self.results = results or []
+
+
+# Raised when an apply was cancelled at a chunk boundary; the build info
+# ConfigMap is never applied for a cancelled apply
+class ApplyCancelled(ApplyError):
+    def __init__(self, message, results=None, total_chunks=0):
+        super().__init__(message, results)
+        self.total_chunks = total_chunks
+
+
+class KubectlThrottled(Throttled):
+    def __init__(self, completed):
+        super().__init__(completed.stderr.strip())
+        self.completed = completed
+
+
+@dataclass
+class ChunkResult:
+    index: int
+    objects: list = field(default_factory=list)
+    returncode: int = 0
+    stdout: str = ""
+    stderr: str = ""
+    duration: float = 0.0
+    cancelled: bool = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.cancelled
+
+
+class KubectlApplier:
+    def __init__(
+        self, settings, discovery_cache=None, governor=None, cancel_event=None
+    ):
+        self.settings = settings
+        self.discovery_cache = discovery_cache
+        self.governor = governor
+        self.cancel_event = cancel_event
+
+    def is_cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def build_command(self):
+        command = ["kubectl", "apply"]
+        if self.discovery_cache is not None:
+            command += self.discovery_cache.kubectl_args()
+        if self.settings.get("kubectl_server_side", True):
+            command += [
+                "--server-side",
+                f"--field-manager={self.settings.get('kubectl_field_manager', 'kube-pico-cd')}",
+            ]
+            if self.settings.get("kubectl_force_conflicts", True):
+                command.append("--force-conflicts")
+        command += ["-f", "-"]
+        return command
+
+    # Function to apply one chunk of documents with a single kubectl process,
+    # under the limits of the governor if there is one
+    def apply_chunk(self, index, documents, priority=False):
+        result = ChunkResult(index, objects=[describe_document(d) for d in documents])
+        if self.is_cancelled():
+            # Chunks that did not start yet are skipped, running ones finish
+            result.cancelled = True
+            return result
+        manifests = dump_documents(documents)
+        start_time = time.monotonic()
+        try:
+            if self.governor is None:
+                completed = self.run_chunk(index, manifests)
+            else:
+                completed = self.governor.call(
+                    [d.get("kind") for d in documents],
+                    self.run_chunk,
+                    index,
+                    manifests,
+                    priority=priority,
+                    measure_latency=False,
+                )
+        except KubectlThrottled as e:
+            completed = e.completed
+        if completed is None:
+            result.cancelled = True
+            return result
+        result.duration = time.monotonic() - start_time
+        result.returncode = completed.returncode
+        result.stdout = completed.stdout
+        result.stderr = completed.stderr
+
+        if result.ok:
+            _logger.info(
+                f"Applied chunk {index} ({len(documents)} objects) in {result.duration:.2f}s"
+            )
+        else:
+            _logger.error(
+                f"Chunk {index} ({len(documents)} objects) failed with exit code {result.returncode}: {result.stderr.strip()}"
+            )
+        return result
+
+    # Function to run kubectl on a chunk. If kubectl fails to map a kind, the
+    # discovery cache is invalidated and the chunk retried once; if it was
+    # throttled, KubectlThrottled is raised for the governor to retry. Returns
+    # None if the apply was cancelled while the chunk waited for its turn.
+    def run_chunk(self, index, manifests):
+        if self.is_cancelled():
+            return None
+        start_time = time.monotonic()
+        completed = self.run_kubectl(manifests)
+        if (
+            completed.returncode != 0
+            and self.discovery_cache is not None
+            and is_unknown_kind_error(completed.stderr)
+        ):
+            self.discovery_cache.invalidate(
+                f"unknown kind in chunk {index}", since=start_time
+            )
+            completed = self.run_kubectl(manifests)
+        if completed.returncode != 0 and is_throttled_error(completed.stderr):
+            raise KubectlThrottled(completed)
+        return completed
+
+    def run_kubectl(self, manifests):
+        return subprocess.run(
+            self.build_command(), input=manifests, capture_output=True, text=True
+        )
+
+    def apply_parallel(self, chunks, first_index):
+        if self.governor is not None:
+            # the governor limits the actual concurrency below the pool size
+            concurrency = self.governor.limiter.maximum
+        else:
+            concurrency = max(1, int(self.settings.get("apply_concurrency", 4)))
+        results = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(self.apply_chunk, first_index + i, chunk)
+                for i, chunk in enumerate(chunks)
+            ]
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(f.result() for f in done)
+                if any(not r.ok for r in results):
+                    # Do not start any further chunks once one of them failed
+                    for future in pending:
+                        future.cancel()
+                    results.extend(f.result() for f in pending if not f.cancelled())
+                    break
+        return sorted(results, key=lambda r: r.index)
+
+    # Function to apply all documents of a bundle. Ordering-sensitive kinds are
+    # applied first in a serial chunk, the rest in parallel chunks, and the
+    # build info ConfigMap last, so that the build identifier is only advanced
+    # if every chunk succeeded.
+    def apply_documents(self, documents, config_map_name, crds_changed=False):
+        build_info = [
+            d for d in documents if is_build_info_config_map(d, config_map_name)
+        ]
+        remaining = [
+            d for d in documents if not is_build_info_config_map(d, config_map_name)
+        ]
+        ordered, chunks = chunk_documents(
+            remaining,
+            max_objects=int(self.settings.get("apply_chunk_max_objects", 100)),
+            max_bytes=int(self.settings.get("apply_chunk_max_bytes", 1000000)),
+        )
+        _logger.info(
+            f"Applying {len(documents)} objects: {len(ordered)} ordering-sensitive, {len(chunks)} parallel chunks"
+        )
+
+        total_chunks = (1 if ordered else 0) + len(chunks) + (1 if build_info else 0)
+        results = []
+        if ordered:
+            results.append(self.apply_chunk(0, ordered))
+            self.raise_for_failures(results, total_chunks)
+            if crds_changed and self.discovery_cache is not None:
+                self.discovery_cache.invalidate("CustomResourceDefinitions changed")
+
+        results += self.apply_parallel(chunks, first_index=len(results))
+        self.raise_for_failures(results, total_chunks)
+
+        if build_info:
+            results.append(self.apply_chunk(len(results), build_info, priority=True))
+            self.raise_for_failures(results, total_chunks)
+
+        return results
+
+    def raise_for_failures(self, results, total_chunks):
+        if self.is_cancelled() and any(r.cancelled for r in results):
+            applied = len([r for r in results if r.ok])
+            raise ApplyCancelled(
+                f"Apply cancelled after {applied} of {total_chunks} chunks, build identifier not advanced",
+                results,
+                total_chunks,
+            )
+        failed = [r for r in results if not r.ok]
+        if failed:
+            summary = "; ".join(
+                f"chunk {r.index} exit code {r.returncode}: {r.stderr.strip()}"
+                for r in failed
+            )
+            raise ApplyError(
+                f"{len(failed)} of {len(results)} chunks failed, build identifier not advanced: {summary}",
+                results,
+            )
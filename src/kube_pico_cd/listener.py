@@ -1,23 +1,70 @@
 import json
 import logging
-import subprocess
-import tempfile
+import os
+import signal
+import threading
+import time
 
-import boto3
+from kube_pico_cd.discovery import DiscoveryCache, crds_changed
+from kube_pico_cd.image_patch import (
+    STRATEGIC_MERGE_PATCH,
+    find_image_only_changes,
+    patch_images,
+)
+from kube_pico_cd.kubectl import ApplyCancelled, ApplyError, KubectlApplier
+from kube_pico_cd.manifests import (
+    dump_documents,
+    is_build_info_config_map,
+    parse_documents,
+)
+from kube_pico_cd.metrics import metrics
+from kube_pico_cd.plan import ERROR, Planner, format_plan
+from kube_pico_cd.pruning import Pruner, stamp_documents
+from kube_pico_cd.rate_limit import ApiGovernor
+from kube_pico_cd.rollout import RolloutTracker
+from kube_pico_cd.status_server import health, start_status_server
+from kube_pico_cd.transport import create_transport
 from kubernetes import client as kube_client
 from kubernetes import config as kube_config
 
 _logger = logging.getLogger(__name__)
 
 
+# Poll interval of the queue while an apply runs
+IN_FLIGHT_POLL_SECONDS = 5
+
+
+# An apply running in a background thread, with the message it came from
+class InFlightApply:
+    def __init__(self, message, build_identifier):
+        self.message = message
+        self.build_identifier = build_identifier
+        self.start_time = time.monotonic()
+        self.last_extended = self.start_time
+        self.superseded_by = None
+        self.error = None
+        self.thread = None
+
+
 class Listener:
     def __init__(self, settings):
         self.settings = settings
         self.kube_api = None
+        self.apps_api = None
+        self.kube_config_loaded = False
+        self.last_applied_documents = None
+        self.discovery_cache = DiscoveryCache(settings)
+        self.governor = ApiGovernor(settings)
+        self.shutting_down = threading.Event()
+        self.cancel_event = threading.Event()
+        self.in_flight = None
+        # Set when an apply was cancelled or failed part-way, so that the
+        # cluster may differ from the last applied documents
+        self.partial_apply = False
 
-    def get_kube_api(self):
-        if self.kube_api is not None:
-            return self.kube_api
+    def load_kube_config(self):
+        if self.kube_config_loaded:
+            return
 
         # Initialize Kubernetes client
         try:
@@ -25,10 +72,44 @@ class Listener:
         except kube_config.config_exception.ConfigException:
             _logger.info("kubeconfig not found, loading in-cluster config")
             kube_config.load_incluster_config()
+        self.kube_config_loaded = True
 
-        self.kube_api = kube_client.CoreV1Api()
+    def get_kube_api(self):
+        if self.kube_api is None:
+            self.load_kube_config()
+            self.kube_api = kube_client.CoreV1Api()
         return self.kube_api
 
+    def get_apps_api(self):
+        if self.apps_api is None:
+            self.load_kube_config()
+            self.apps_api = kube_client.AppsV1Api()
+        return self.apps_api
+
+    def get_dynamic_client(self):
+        self.load_kube_config()
+        return self.discovery_cache.get_dynamic_client(kube_client.ApiClient())
+
+    # Function to get the last applied desired state, either from memory or
+    # from the state file if one is configured
+    def get_last_applied_documents(self):
+        if self.last_applied_documents is None:
+            state_file = self.settings.get("last_applied_state_file")
+            if state_file and os.path.exists(state_file):
+                with open(state_file, "r") as file:
+                    self.last_applied_documents = parse_documents(file.read())
+                _logger.info(f"Loaded last applied state from {state_file}")
+        return self.last_applied_documents
+
+    def set_last_applied_documents(self, documents):
+        self.last_applied_documents = documents
+        state_file = self.settings.get("last_applied_state_file")
+        if state_file:
+            tmp_file = f"{state_file}.tmp"
+            with open(tmp_file, "w") as file:
+                file.write(dump_documents(documents))
+            os.replace(tmp_file, state_file)
+
     # Function to get the current build timestamp from the ConfigMap
     def get_current_incremental_identifier(self):
         build_identifier_key = self.settings.build_incremental_identifier
@@ -47,12 +128,334 @@ class Listener:
             _logger.warning(f"Failed to get current timestamp: {e}")
             return 0
 
-    # Function to apply manifests using kubectl
-    def apply_manifests(self, manifests):
-        with tempfile.NamedTemporaryFile(suffix=".yaml", delete=False) as tmpfile:
-            tmpfile.write(manifests.encode())
-            tmpfile.flush()
-            subprocess.run(["kubectl", "apply", "-f", tmpfile.name])
+    # Function to apply manifests, either by patching only the changed images or
+    # by a full apply using chunked, parallel kubectl processes
+    def apply_manifests(self, manifests, build_identifier=None):
+        start_time = time.monotonic()
+        documents = parse_documents(manifests)
+        config_map_name = self.settings.config_map_name
+
+        image_changes = None
+        previous_documents = self.get_last_applied_documents()
+        if (
+            self.settings.get("image_fast_path", True)
+            and previous_documents
+            and not self.partial_apply
+        ):
+            image_changes = find_image_only_changes(
+                previous_documents, documents, config_map_name
+            )
+
+        try:
+            if image_changes is not None:
+                _logger.info(
+                    f"Image-only change: patching {len(image_changes)} workloads instead of applying {len(documents)} objects"
+                )
+                self.apply_image_changes(image_changes, documents)
+            else:
+                _logger.info(f"Full apply of {len(documents)} objects")
+                if self.settings.get("plan_before_apply", False):
+                    self.check_plan(documents, build_identifier)
+                applier = KubectlApplier(
+                    self.settings,
+                    self.discovery_cache,
+                    self.governor,
+                    self.cancel_event,
+                )
+                applier.apply_documents(
+                    stamp_documents(documents, self.get_owning_set(), build_identifier),
+                    config_map_name,
+                    crds_changed=crds_changed(previous_documents, documents),
+                )
+        except Exception:
+            # Part of the bundle may be in the cluster, so the next build is
+            # not compared against the last applied documents
+            self.partial_apply = True
+            raise
+        self.partial_apply = False
+
+        self.set_last_applied_documents(documents)
+
+        # An image-only change keeps the set of objects, so there is nothing to prune
+        if image_changes is None and self.settings.get("prune", False):
+            self.prune(documents, previous_documents)
+
+        if self.settings.get("rollout_tracking", False):
+            self.track_rollout(documents, build_identifier, start_time)
+
+    # Function to report the rollout of an applied build. The build is already
+    # applied at this point, so failures are only logged.
+    def track_rollout(self, documents, build_identifier, start_time):
+        try:
+            tracker = RolloutTracker(
+                self.get_apps_api(),
+                self.settings.kube_namespace,
+                int(self.settings.get("rollout_timeout_seconds", 600)),
+            )
+            tracker.track(documents, build_identifier, start_time, self.cancel_event)
+        except Exception as e:
+            _logger.error(f"Failed to track rollout of build {build_identifier}: {e}")
+
+    # Function to compute what applying the documents would do, with
+    # server-side dry-run applies of the stamped documents
+    def plan_documents(self, documents, build_identifier=None):
+        planner = Planner(
+            self.get_dynamic_client(),
+            self.governor,
+            self.settings.get("kubectl_field_manager", "kube-pico-cd"),
+            self.settings.kube_namespace,
+        )
+        return planner.plan(
+            stamp_documents(documents, self.get_owning_set(), build_identifier)
+        )
+
+    def plan_manifests(self, manifests):
+        return self.plan_documents(parse_documents(manifests))
+
+    # Function to gate an apply on a plan without errors
+    def check_plan(self, documents, build_identifier):
+        entries = self.plan_documents(documents, build_identifier)
+        report = format_plan(entries)
+        errors = [entry for entry in entries if entry.action == ERROR]
+        if errors:
+            raise ApplyError(
+                f"Plan for build {build_identifier} has {len(errors)} errors, not applying:\n{report}"
+            )
+        _logger.info(f"Plan for build {build_identifier}:\n{report}")
+
+    def get_owning_set(self):
+        return self.settings.get("owning_set") or self.settings.kube_namespace
+
+    # Function to delete the objects that disappeared from the bundle. The
+    # apply already succeeded at this point, so failures are only logged.
+    def prune(self, documents, previous_documents):
+        try:
+            pruner = Pruner(
+                self.get_dynamic_client(),
+                self.governor,
+                self.get_owning_set(),
+                self.settings.kube_namespace,
+            )
+            pruner.prune(
+                documents,
+                previous_documents,
+                extra_kinds=self.settings.get("prune_kinds", []),
+                dry_run=self.settings.get("prune_dry_run", False),
+            )
+        except Exception as e:
+            _logger.error(f"Failed to prune stale objects: {e}")
+
+    def apply_image_changes(self, image_changes, documents):
+        namespace = self.settings.kube_namespace
+        field_manager = self.settings.get("kubectl_field_manager", "kube-pico-cd")
+        try:
+            patch_images(
+                self.get_apps_api(),
+                image_changes,
+                namespace,
+                field_manager,
+                self.governor,
+            )
+            if self.cancel_event.is_set():
+                raise ApplyCancelled(
+                    "Image patch cancelled, build identifier not advanced"
+                )
+            # The build info ConfigMap is written last, so that the build
+            # identifier is only advanced once all workloads are patched
+            for document in documents:
+                if is_build_info_config_map(document, self.settings.config_map_name):
+                    self.governor.call(
+                        "ConfigMap",
+                        self.get_kube_api().patch_namespaced_config_map,
+                        document["metadata"]["name"],
+                        document["metadata"].get("namespace", namespace),
+                        {"data": document.get("data") or {}},
+                        field_manager=field_manager,
+                        _content_type=STRATEGIC_MERGE_PATCH,
+                        priority=True,
+                    )
+        except kube_client.exceptions.ApiException as e:
+            raise ApplyError(
+                f"Failed to patch images, build identifier not advanced: {e}"
+            )
+
+    # Function to stop receiving messages and to cancel the in-flight apply at
+    # the next chunk boundary, used as handler of SIGTERM and SIGINT
+    def shutdown(self, signum=None, frame=None):
+        _logger.info(f"Received signal {signum}, draining")
+        health.set_ready(False)
+        self.shutting_down.set()
+        self.cancel_event.set()
+
+    # Function to make a message visible again immediately, so that a
+    # successor picks it up without waiting for the visibility timeout
+    def release_message(self, transport, message):
+        _logger.info("Releasing unprocessed message")
+        transport.extend_visibility(message, 0)
+
+    def start_apply(self, message, manifests, build_identifier):
+        self.cancel_event.clear()
+        if self.shutting_down.is_set():
+            self.cancel_event.set()
+        in_flight = InFlightApply(message, build_identifier)
+
+        def run():
+            try:
+                self.apply_manifests(manifests, build_identifier)
+            except Exception as e:
+                in_flight.error = e
+
+        in_flight.thread = threading.Thread(
+            target=run, name=f"apply-{build_identifier}", daemon=True
+        )
+        in_flight.thread.start()
+        self.in_flight = in_flight
+
+    # Function to keep the message of the in-flight apply invisible to other
+    # consumers for as long as the apply runs
+    def keep_in_flight_message(self, transport):
+        visibility_timeout = int(self.settings.get("visibility_timeout", 300))
+        in_flight = self.in_flight
+        if time.monotonic() - in_flight.last_extended >= visibility_timeout / 2:
+            transport.extend_visibility(in_flight.message, visibility_timeout)
+            in_flight.last_extended = time.monotonic()
+
+    # Function to acknowledge or release the message of a finished apply
+    def finish_apply(self, transport):
+        in_flight = self.in_flight
+        in_flight.thread.join()
+        self.in_flight = None
+        error = in_flight.error
+        if error is None:
+            transport.ack(in_flight.message)
+            print(f"Processed message with timestamp {in_flight.build_identifier}")
+            return
+
+        if isinstance(error, ApplyCancelled) and in_flight.superseded_by is not None:
+            self.log_preemption(in_flight, error)
+        elif isinstance(error, ApplyCancelled):
+            # Cancelled by a shutdown
+            _logger.warning(f"{error}")
+        elif isinstance(error, ApplyError):
+            _logger.error(
+                f"Failed to apply manifests for build {in_flight.build_identifier}: {error}"
+            )
+        else:
+            # An unexpected error fails this build only, the listener
+            # keeps running
+            _logger.error(
+                f"Unexpected error applying manifests for build {in_flight.build_identifier}: {error}",
+                exc_info=error,
+            )
+        if in_flight.superseded_by is not None:
+            transport.ack(in_flight.message)
+        elif self.shutting_down.is_set():
+            # A successor picks the build up without waiting for the
+            # visibility timeout
+            self.release_message(transport, in_flight.message)
+        # Otherwise keep the message, it will be redelivered after the
+        # visibility timeout, unless a newer build supersedes it
+
+    def log_preemption(self, in_flight, error):
+        elapsed = time.monotonic() - in_flight.start_time
+        applied = [r for r in error.results if r.ok]
+        skipped = error.total_chunks - len(applied)
+        metrics.inc_counter(
+            "kube_pico_cd_preempted_builds_total",
+            1,
+            "Number of applies cancelled because a newer build arrived",
+        )
+        if not applied or skipped <= 0:
+            _logger.info(
+                f"Preempted build {in_flight.build_identifier} for build {in_flight.superseded_by} after {elapsed:.1f}s"
+            )
+            return
+
+        # The skipped chunks would have run with the current concurrency
+        average_duration = sum(r.duration for r in applied) / len(applied)
+        saved = skipped * average_duration / max(1.0, self.governor.limiter.limit)
+        metrics.inc_counter(
+            "kube_pico_cd_preemption_saved_seconds_total",
+            saved,
+            "Estimated apply time saved by cancelling superseded builds",
+        )
+        _logger.info(
+            f"Preempted build {in_flight.build_identifier} for build {in_flight.superseded_by} after {elapsed:.1f}s:"
+            f" skipped {skipped} of {error.total_chunks} chunks, saving about {saved:.1f}s"
+        )
+
+    def handle_message(self, transport, message):
+        build_identifier_key = self.settings.build_incremental_identifier
+        _logger.info(f"Received message {message.body}")
+
+        body = json.loads(message.body)
+
+        # Get the build timestamp and manifests from the message
+        if build_identifier_key not in body["data"]:
+            _logger.warning(
+                f"Message does not contain {build_identifier_key}, skipping"
+            )
+            transport.ack(message)
+            return
+        message_build_identifier = int(body["data"][build_identifier_key])
+        manifests = body["manifests"]
+
+        in_flight = self.in_flight
+        if (
+            in_flight is not None
+            and message.message_id is not None
+            and message.message_id == in_flight.message.message_id
+        ):
+            # The visibility timeout of the in-flight message expired and it
+            # was received again. It is acknowledged when the apply finishes,
+            # with the handle of the latest receive.
+            _logger.warning(
+                f"Message of build {in_flight.build_identifier} was redelivered while being applied"
+            )
+            in_flight.message = message
+            in_flight.last_extended = time.monotonic()
+            return
+        if (
+            in_flight is not None
+            and message_build_identifier <= in_flight.build_identifier
+        ):
+            _logger.info(
+                f"Skipping build {message_build_identifier} because build {in_flight.build_identifier} is being applied"
+            )
+            transport.ack(message)
+            return
+
+        # Check if the received build timestamp is newer
+        current_incremental_identifier = self.get_current_incremental_identifier()
+        _logger.info(
+            f"Current incremental identfier {build_identifier_key} is {current_incremental_identifier}, build identifier in message is {message_build_identifier}"
+        )
+        # Note: We will also apply the manifests if the build timestamp is equal to the current timestamp
+        # this is to handle the case where we crashed during the previous apply, but were already
+        # able to update the build timestamp in the ConfigMap
+        # the message would then stay in the queue, and we would get it again here after a restart
+        # and we will detect an equal build number, and apply the manifests again.
+        # This however requires that the upstream processes must make sure that equal build numbers have equal content
+        if message_build_identifier < current_incremental_identifier:
+            _logger.info(
+                f"Skipping build {message_build_identifier} because it is older than the current timestamp {current_incremental_identifier}"
+            )
+            transport.ack(message)
+            print(f"Processed message with timestamp {message_build_identifier}")
+            return
+
+        if in_flight is not None:
+            # The older apply stops at the next chunk boundary and never
+            # advances the build identifier
+            _logger.info(
+                f"Build {message_build_identifier} supersedes build {in_flight.build_identifier}, cancelling its apply"
+            )
+            in_flight.superseded_by = message_build_identifier
+            self.cancel_event.set()
+            self.finish_apply(transport)
+
+        _logger.info(f"Applying manifests for build {message_build_identifier}")
+        self.start_apply(message, manifests, message_build_identifier)
 
     def start(self):
         if "kube_namespace" not in self.settings:
@@ -60,62 +463,45 @@ class Listener:
                 "kube_namespace is neither given as argument, not set in settings, and cannot be determined from the service account"
             )
         _logger.info(f"Using namespace {self.settings.kube_namespace}")
-        build_identifier_key = self.settings.build_incremental_identifier
 
-        # Initialize AWS SQS resource
-        sqs = boto3.resource("sqs")
         deploy_queue_name = self.settings.deploy_queue_name
+        transport = create_transport(self.settings, deploy_queue_name)
+        self.discovery_cache.warm()
+        if int(self.settings.get("status_port", 0)) > 0:
+            start_status_server(int(self.settings.status_port))
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        health.liveness_timeout = int(
+            self.settings.get("liveness_timeout_seconds", 900)
+        )
+        health.set_ready(True)
 
-        # read messages for an aws SQS queue
-        queue = sqs.get_queue_by_name(QueueName=deploy_queue_name)
+        # Applies run in a background thread, while this loop keeps receiving
+        # messages, so that a newer build can preempt the in-flight one
         idle_loop_counter = 0
-        while True:
-            if idle_loop_counter % 50 == 0:
-                _logger.info(
-                    f"Waiting for messages on queue {deploy_queue_name}, idle for {idle_loop_counter} loops"
-                )
-            idle_loop_counter += 1
-            for message in queue.receive_messages(WaitTimeSeconds=20):
-                idle_loop_counter = 0
-                _logger.info(f"Received message {message.body}")
-
-                body = json.loads(message.body)
-
-                # Get the build timestamp and manifests from the message
-                if build_identifier_key in body["data"]:
-                    message_build_identifier = int(body["data"][build_identifier_key])
-
-                    manifests = body["manifests"]
-
-                    # Check if the received build timestamp is newer
-                    current_incremental_identifier = (
-                        self.get_current_incremental_identifier()
-                    )
+        while not self.shutting_down.is_set() or self.in_flight is not None:
+            health.beat()
+            if self.in_flight is not None:
+                if self.shutting_down.is_set():
+                    # The apply stops at the next chunk boundary
+                    self.in_flight.thread.join()
+                if not self.in_flight.thread.is_alive():
+                    self.finish_apply(transport)
+                    continue
+                self.keep_in_flight_message(transport)
+                wait_seconds = IN_FLIGHT_POLL_SECONDS
+            else:
+                if idle_loop_counter % 50 == 0:
                     _logger.info(
-                        f"Current incremental identfier {build_identifier_key} is {current_incremental_identifier}, build identifier in message is {message_build_identifier}"
-                    )
-                    if message_build_identifier >= current_incremental_identifier:
-                        # Note: We will also apply the manifests if the build timestamp is equal to the current timestamp
-                        # this is to handle the case where we crashed during the previous apply, but were already
-                        # able to update the build timestamp in the ConfigMap
-                        # the message would then stay in the queue, and we would get it again here after a restart
-                        # and we will detect an equal build number, and apply the manifests again.
-                        # This however requires that the upstream processes must make sure that equal build numbers have equal content
-
-                        _logger.info(
-                            f"Applying manifests for build {message_build_identifier}"
-                        )
-                        self.apply_manifests(manifests)
-
-                    else:
-                        _logger.info(
-                            f"Skipping build {message_build_identifier} because it is older than the current timestamp {current_incremental_identifier}"
-                        )
-                else:
-                    _logger.warning(
-                        f"Message does not contain {build_identifier_key}, skipping"
+                        f"Waiting for messages on queue {deploy_queue_name}, idle for {idle_loop_counter} loops"
                     )
+                idle_loop_counter += 1
+                wait_seconds = 20
+            for message in transport.receive_batch(wait_seconds=wait_seconds):
+                idle_loop_counter = 0
+                if self.shutting_down.is_set():
+                    self.release_message(transport, message)
+                    continue
+                self.handle_message(transport, message)
 
-                message.delete()
-
-                print(f"Processed message with timestamp {message_build_identifier}")
+        _logger.info("Listener stopped")
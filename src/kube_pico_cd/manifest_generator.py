@@ -54,6 +54,8 @@ def generate_manifest(namespace, queue_name, aws_region, filename=None):
                         "metadata": {"labels": {"app": "kube-pico-cd"}},
                         "spec": {
                             "serviceAccountName": service_account_name,
+                            # Leaves time to finish the in-flight chunk on SIGTERM
+                            "terminationGracePeriodSeconds": 90,
                             "containers": [
                                 {
                                     "name": "kube-pico-cd-container",
@@ -68,6 +70,24 @@ def generate_manifest(namespace, queue_name, aws_region, filename=None):
                                             "value": aws_region,
                                         },
                                     ],
+                                    "ports": [
+                                        {"name": "status", "containerPort": 8080}
+                                    ],
+                                    "livenessProbe": {
+                                        "httpGet": {
+                                            "path": "/healthz",
+                                            "port": "status",
+                                        },
+                                        "periodSeconds": 30,
+                                        "failureThreshold": 3,
+                                    },
+                                    "readinessProbe": {
+                                        "httpGet": {
+                                            "path": "/readyz",
+                                            "port": "status",
+                                        },
+                                        "periodSeconds": 10,
+                                    },
                                 }
                             ],
                         },
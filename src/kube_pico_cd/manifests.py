@@ -0,0 +1,83 @@
+import logging
+
+import yaml
+
+_logger = logging.getLogger(__name__)
+
+
+# Kinds that other objects in the same bundle may depend on, and that therefore
+# have to exist before anything else is applied
+ORDERING_SENSITIVE_KINDS = ("Namespace", "CustomResourceDefinition")
+
+
+# Function to parse a multi-document YAML string into a flat list of documents
+def parse_documents(manifests):
+    documents = []
+    for document in yaml.safe_load_all(manifests):
+        if not document:
+            continue
+        if document.get("kind") == "List":
+            documents.extend(item for item in document.get("items") or [] if item)
+        else:
+            documents.append(document)
+    return documents
+
+
+def dump_documents(documents):
+    return yaml.safe_dump_all(documents, default_flow_style=False)
+
+
+def document_key(document, default_namespace=None):
+    metadata = document.get("metadata") or {}
+    return (
+        document.get("apiVersion"),
+        document.get("kind"),
+        metadata.get("namespace", default_namespace),
+        metadata.get("name"),
+    )
+
+
+def split_api_version(api_version):
+    if "/" in api_version:
+        group, version = api_version.split("/", 1)
+        return group, version
+    return "", api_version
+
+
+def describe_document(document):
+    metadata = document.get("metadata") or {}
+    return f"{document.get('kind')}/{metadata.get('name')}"
+
+
+def is_build_info_config_map(document, config_map_name):
+    return (
+        document.get("kind") == "ConfigMap"
+        and (document.get("metadata") or {}).get("name") == config_map_name
+    )
+
+
+# Function to split documents into apply chunks. The first chunk holds the
+# ordering-sensitive kinds and must be applied before all others; the remaining
+# chunks are bounded by object count and serialized size and may be applied in
+# any order.
+def chunk_documents(documents, max_objects, max_bytes):
+    ordered = [d for d in documents if d.get("kind") in ORDERING_SENSITIVE_KINDS]
+    unordered = [d for d in documents if d.get("kind") not in ORDERING_SENSITIVE_KINDS]
+
+    chunks = []
+    current = []
+    current_bytes = 0
+    for document in unordered:
+        document_bytes = len(yaml.safe_dump(document))
+        if current and (
+            len(current) >= max_objects or current_bytes + document_bytes > max_bytes
+        ):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(document)
+        current_bytes += document_bytes
+    if current:
+        chunks.append(current)
+
+    return ordered, chunks
@@ -0,0 +1,61 @@
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+# Minimal in-process metrics registry, rendered in the Prometheus text format
+# by the status server
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.helps = {}
+        self.values = {}
+
+    def _register(self, name, metric_type, help_text):
+        self.types.setdefault(name, metric_type)
+        self.helps.setdefault(name, help_text)
+
+    def set_gauge(self, name, value, help_text="", labels=None):
+        with self.lock:
+            self._register(name, "gauge", help_text)
+            self.values[(name, tuple(sorted((labels or {}).items())))] = value
+
+    def inc_counter(self, name, amount=1, help_text="", labels=None):
+        with self.lock:
+            self._register(name, "counter", help_text)
+            key = (name, tuple(sorted((labels or {}).items())))
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, help_text="", labels=None):
+        with self.lock:
+            self._register(name, "summary", help_text)
+            label_items = tuple(sorted((labels or {}).items()))
+            for suffix, amount in (("_count", 1), ("_sum", value)):
+                key = (name + suffix, label_items)
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                lines.append(f"# HELP {name} {self.helps[name]}")
+                lines.append(f"# TYPE {name} {self.types[name]}")
+                for (sample_name, labels), value in sorted(self.values.items()):
+                    if sample_name in (name, f"{name}_count", f"{name}_sum"):
+                        lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
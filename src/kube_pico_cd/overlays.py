@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+
+import yaml
+from kube_pico_cd.manifests import describe_document, document_key, dump_documents
+
+_logger = logging.getLogger(__name__)
+
+
+OVERLAY_CONFIG_FILE = "overlay.yaml"
+
+# ${NAME} references a variable, $${NAME} is a literal ${NAME}
+VARIABLE_PATTERN = re.compile(r"\$(\$?)\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class UndefinedVariable(Exception):
+    def __init__(self, name):
+        super().__init__(
+            f"Undefined variable ${{{name}}}, use $${{{name}}} for a literal"
+        )
+        self.name = name
+
+
+def substitute(value, variables):
+    if isinstance(value, dict):
+        return {key: substitute(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if not isinstance(value, str) or "${" not in value:
+        return value
+
+    def replace(match):
+        escaped, name = match.groups()
+        if escaped:
+            return "${" + name + "}"
+        if name not in variables:
+            raise UndefinedVariable(name)
+        return str(variables[name])
+
+    match = VARIABLE_PATTERN.fullmatch(value)
+    if match and not match.group(1):
+        # A scalar that consists of a single variable takes the type of its value
+        if match.group(2) not in variables:
+            raise UndefinedVariable(match.group(2))
+        return variables[match.group(2)]
+    return VARIABLE_PATTERN.sub(replace, value)
+
+
+# Keys by which the items of lists of objects are merged, by field name, as
+# the patchMergeKey of the Kubernetes API types. Where several types use the
+# same field name, the first key present in all items is used (container
+# ports by containerPort, Service ports by port). Other lists are replaced.
+MERGE_KEYS = {
+    "containers": ("name",),
+    "initContainers": ("name",),
+    "ephemeralContainers": ("name",),
+    "env": ("name",),
+    "volumes": ("name",),
+    "volumeMounts": ("mountPath",),
+    "volumeDevices": ("devicePath",),
+    "ports": ("containerPort", "port"),
+    "imagePullSecrets": ("name",),
+    "hostAliases": ("ip",),
+    "topologySpreadConstraints": ("topologyKey",),
+    "readinessGates": ("conditionType",),
+    "resourceClaims": ("name",),
+    "schedulingGates": ("name",),
+    "secrets": ("name",),
+    "ownerReferences": ("uid",),
+    "conditions": ("type",),
+}
+
+
+def _merge_key(field, base_list, patch_list):
+    items = base_list + patch_list
+    if field not in MERGE_KEYS or not items:
+        return None
+    if not all(isinstance(item, dict) for item in items):
+        return None
+    for key in MERGE_KEYS[field]:
+        if all(key in item for item in items):
+            return key
+    raise Exception(
+        f"Items of {field} cannot be merged, not all of them have one of {', '.join(MERGE_KEYS[field])}"
+    )
+
+
+# Function to merge a patch into a document like a strategic merge patch:
+# maps are merged recursively, null values and "$patch: delete" remove
+# entries, lists of objects are merged by the merge key of their field (see
+# MERGE_KEYS), other lists are replaced. Neither argument is modified.
+def strategic_merge(base, patch, field=None):
+    if isinstance(base, dict) and isinstance(patch, dict):
+        merged = dict(base)
+        for key, value in patch.items():
+            if value is None:
+                merged.pop(key, None)
+            elif isinstance(value, dict) and value.get("$patch") == "delete":
+                merged.pop(key, None)
+            elif key in merged:
+                merged[key] = strategic_merge(merged[key], value, key)
+            else:
+                merged[key] = (
+                    strategic_merge({}, value) if isinstance(value, dict) else value
+                )
+        return merged
+
+    if isinstance(base, list) and isinstance(patch, list):
+        merge_key = _merge_key(field, base, patch)
+        if merge_key is None:
+            return patch
+        merged = list(base)
+        positions = {}
+        for i, item in enumerate(merged):
+            if item[merge_key] in positions:
+                raise Exception(
+                    f"Duplicate {merge_key} {item[merge_key]!r} in {field}, cannot merge"
+                )
+            positions[item[merge_key]] = i
+        deleted = set()
+        patched = set()
+        for item in patch:
+            item_key = item[merge_key]
+            if item_key in patched:
+                raise Exception(
+                    f"Duplicate {merge_key} {item_key!r} in patch of {field}"
+                )
+            patched.add(item_key)
+            if item.get("$patch") == "delete":
+                deleted.add(item_key)
+            elif item_key in positions:
+                merged[positions[item_key]] = strategic_merge(
+                    merged[positions[item_key]], item
+                )
+            else:
+                positions[item_key] = len(merged)
+                merged.append(item)
+        return [item for item in merged if item[merge_key] not in deleted]
+
+    return patch
+
+
+class Overlay:
+    def __init__(self, name, variables=None, patches=None, deploy_queue_name=None):
+        self.name = name
+        self.variables = variables or {}
+        self.patches = patches or []
+        self.deploy_queue_name = deploy_queue_name
+
+
+# Function to load the overlays of overlays_root. Every subdirectory is an
+# environment, with an optional overlay.yaml (variables, deploy_queue_name)
+# and any number of further YAML files holding strategic merge patches.
+def load_overlays(overlays_root, environments=None):
+    overlays_root = Path(overlays_root)
+    if not environments:
+        environments = sorted(p.name for p in overlays_root.iterdir() if p.is_dir())
+
+    overlays = []
+    for environment in environments:
+        directory = overlays_root / environment
+        if not directory.is_dir():
+            raise Exception(f"No overlay directory {directory}")
+        config = {}
+        patches = []
+        for path in sorted(directory.rglob("*.yaml")):
+            with open(path, "r") as file:
+                if path.name == OVERLAY_CONFIG_FILE and path.parent == directory:
+                    config = yaml.safe_load(file) or {}
+                else:
+                    patches.extend(d for d in yaml.safe_load_all(file) if d)
+        overlays.append(
+            Overlay(
+                environment,
+                variables=config.get("variables"),
+                patches=patches,
+                deploy_queue_name=config.get("deploy_queue_name"),
+            )
+        )
+    return overlays
+
+
+# Renders a base manifest tree for several environments. Every base file is
+# read and parsed once; rendering works on the parsed documents, which are
+# never modified, and produces sorted, deterministic YAML.
+class OverlayRenderer:
+    def __init__(self, base_root):
+        self.base_root = Path(base_root)
+        self.cache = {}
+
+    def base_documents(self):
+        paths = sorted(self.base_root.rglob("*.yaml"))
+        if len(paths) == 0:
+            full_path = os.path.abspath(self.base_root)
+            raise Exception(f"No YAML files found in {self.base_root} ({full_path})")
+
+        documents = []
+        for path in paths:
+            mtime = path.stat().st_mtime_ns
+            cached = self.cache.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path, "r") as file:
+                    cached = (mtime, [d for d in yaml.safe_load_all(file) if d])
+                self.cache[path] = cached
+            documents.extend(cached[1])
+        return documents
+
+    def substitute(self, document, overlay):
+        try:
+            return substitute(document, overlay.variables)
+        except UndefinedVariable as e:
+            raise Exception(
+                f"{e} in {describe_document(document)} of overlay {overlay.name}"
+            )
+
+    def render_documents(self, overlay):
+        documents = [self.substitute(d, overlay) for d in self.base_documents()]
+        positions = {document_key(d): i for i, d in enumerate(documents)}
+        for patch in overlay.patches:
+            patch = self.substitute(patch, overlay)
+            key = document_key(patch)
+            if key not in positions:
+                raise Exception(
+                    f"Patch {describe_document(patch)} of overlay {overlay.name} matches no base document"
+                )
+            documents[positions[key]] = strategic_merge(
+                documents[positions[key]], patch
+            )
+        return documents
+
+    # Function to render the manifests of an environment, returns the YAML
+    # text and its SHA-256 hash
+    def render(self, overlay):
+        manifests = dump_documents(self.render_documents(overlay)) + "---\n"
+        digest = hashlib.sha256(manifests.encode()).hexdigest()
+        _logger.info(f"Rendered overlay {overlay.name}, sha256 {digest}")
+        return manifests, digest
@@ -0,0 +1,216 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from kube_pico_cd.manifests import describe_document, split_api_version
+from kube_pico_cd.pruning import BUILD_LABEL
+from kubernetes.client.exceptions import ApiException
+from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
+
+_logger = logging.getLogger(__name__)
+
+
+# Fields maintained by the API server, which are not part of a plan
+IGNORED_METADATA_FIELDS = (
+    "managedFields",
+    "resourceVersion",
+    "generation",
+    "uid",
+    "creationTimestamp",
+    "selfLink",
+)
+
+CREATE = "create"
+CHANGE = "change"
+UNCHANGED = "unchanged"
+ERROR = "error"
+
+
+@dataclass
+class PlanEntry:
+    description: str
+    namespace: str = None
+    action: str = UNCHANGED
+    diffs: list = field(default_factory=list)
+    error: str = None
+
+
+def _error_message(e):
+    return e.summary() if hasattr(e, "summary") else str(e)
+
+
+def normalize(obj):
+    obj = dict(obj)
+    obj.pop("status", None)
+    metadata = dict(obj.get("metadata") or {})
+    for ignored in IGNORED_METADATA_FIELDS:
+        metadata.pop(ignored, None)
+    labels = dict(metadata.get("labels") or {})
+    labels.pop(BUILD_LABEL, None)
+    if labels:
+        metadata["labels"] = labels
+    else:
+        metadata.pop("labels", None)
+    obj["metadata"] = metadata
+    return obj
+
+
+# Function to replace the values of the data and stringData of two versions
+# of a Secret by placeholders, like kubectl diff does, so that plans never
+# show secret values. Changed values are told apart by their placeholders.
+def mask_secret_data(old, new):
+    old, new = dict(old), dict(new)
+    for field_name in ("data", "stringData"):
+        old_data = old.get(field_name) or {}
+        new_data = new.get(field_name) or {}
+        old_masked, new_masked = {}, {}
+        for key in set(old_data) | set(new_data):
+            if key in old_data and key in new_data and old_data[key] != new_data[key]:
+                old_masked[key] = "*** (before)"
+                new_masked[key] = "*** (after)"
+                continue
+            if key in old_data:
+                old_masked[key] = "***"
+            if key in new_data:
+                new_masked[key] = "***"
+        if field_name in old:
+            old[field_name] = old_masked
+        if field_name in new:
+            new[field_name] = new_masked
+    return old, new
+
+
+# Function to list the field-level differences of two objects as
+# (path, old value, new value) tuples
+def diff_objects(old, new, path=""):
+    if isinstance(old, dict) and isinstance(new, dict):
+        diffs = []
+        for key in sorted(set(old) | set(new), key=str):
+            child_path = f"{path}.{key}" if path else str(key)
+            diffs += diff_objects(old.get(key), new.get(key), child_path)
+        return diffs
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        diffs = []
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            diffs += diff_objects(old_item, new_item, f"{path}[{i}]")
+        return diffs
+    if old != new:
+        return [(path, old, new)]
+    return []
+
+
+# Computes what applying a bundle would do, with server-side dry-run applies
+# of all documents in parallel under the limits of the API governor
+class Planner:
+    def __init__(self, dynamic_client, governor, field_manager, default_namespace):
+        self.dynamic_client = dynamic_client
+        self.governor = governor
+        self.field_manager = field_manager
+        self.default_namespace = default_namespace
+        self.bundle_namespaces = set()
+        self.bundle_crd_kinds = set()
+
+    def plan_document(self, document):
+        metadata = document.get("metadata") or {}
+        kind = document.get("kind")
+        entry = PlanEntry(describe_document(document))
+        try:
+            resource = self.dynamic_client.resources.get(
+                api_version=document.get("apiVersion"), kind=kind
+            )
+        except ResourceNotFoundError:
+            group, _ = split_api_version(document.get("apiVersion", ""))
+            if (group, kind) in self.bundle_crd_kinds:
+                entry.action = CREATE
+            else:
+                entry.action = ERROR
+                entry.error = f"{document.get('apiVersion')} {kind} is not served"
+            return entry
+
+        namespace = None
+        if resource.namespaced:
+            namespace = metadata.get("namespace", self.default_namespace)
+        entry.namespace = namespace
+
+        try:
+            live = self.governor.call(
+                kind, resource.get, name=metadata.get("name"), namespace=namespace
+            ).to_dict()
+        except NotFoundError:
+            live = None
+        except ApiException as e:
+            entry.action = ERROR
+            entry.error = _error_message(e)
+            return entry
+
+        try:
+            planned = self.governor.call(
+                kind,
+                self.dynamic_client.server_side_apply,
+                resource,
+                body=document,
+                namespace=namespace,
+                field_manager=self.field_manager,
+                force_conflicts=True,
+                dry_run="All",
+            ).to_dict()
+        except NotFoundError as e:
+            if live is None and namespace in self.bundle_namespaces:
+                # the namespace is created by the same bundle
+                entry.action = CREATE
+            else:
+                entry.action = ERROR
+                entry.error = _error_message(e)
+            return entry
+        except ApiException as e:
+            entry.action = ERROR
+            entry.error = _error_message(e)
+            return entry
+
+        if live is None:
+            entry.action = CREATE
+        else:
+            live, planned = normalize(live), normalize(planned)
+            if kind == "Secret":
+                live, planned = mask_secret_data(live, planned)
+            entry.diffs = diff_objects(live, planned)
+            entry.action = CHANGE if entry.diffs else UNCHANGED
+        return entry
+
+    def plan(self, documents):
+        self.bundle_namespaces = {
+            (d.get("metadata") or {}).get("name")
+            for d in documents
+            if d.get("kind") == "Namespace"
+        }
+        self.bundle_crd_kinds = {
+            (
+                (d.get("spec") or {}).get("group"),
+                ((d.get("spec") or {}).get("names") or {}).get("kind"),
+            )
+            for d in documents
+            if d.get("kind") == "CustomResourceDefinition"
+        }
+        with ThreadPoolExecutor(max_workers=self.governor.limiter.maximum) as executor:
+            return list(executor.map(self.plan_document, documents))
+
+
+def format_plan(entries):
+    symbols = {CREATE: "+", CHANGE: "~", UNCHANGED: "=", ERROR: "!"}
+    lines = []
+    for entry in entries:
+        location = f" in namespace {entry.namespace}" if entry.namespace else ""
+        lines.append(
+            f"{symbols[entry.action]} {entry.description}{location}: {entry.action}"
+        )
+        if entry.error:
+            lines.append(f"    {entry.error}")
+        for path, old, new in entry.diffs:
+            lines.append(f"    {path}: {old!r} -> {new!r}")
+    counts = {action: 0 for action in symbols}
+    for entry in entries:
+        counts[entry.action] += 1
+    lines.append(
+        f"Plan: {counts[CREATE]} to create, {counts[CHANGE]} to change, {counts[UNCHANGED]} unchanged, {counts[ERROR]} errors"
+    )
+    return "\n".join(lines)
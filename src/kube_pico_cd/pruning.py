@@ -0,0 +1,151 @@
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from kube_pico_cd.manifests import split_api_version
+from kube_pico_cd.metrics import metrics
+from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
+
+_logger = logging.getLogger(__name__)
+
+
+OWNING_SET_LABEL = "kube-pico-cd/owning-set"
+BUILD_LABEL = "kube-pico-cd/build"
+# Objects with this annotation set to "true" are never pruned
+PROTECTED_ANNOTATION = "kube-pico-cd/prune-protected"
+
+
+# Function to label copies of the documents with the owning set and the build
+# identifier, so that objects that disappear from the bundle can be found
+def stamp_documents(documents, owning_set, build_identifier=None):
+    stamped = []
+    for document in documents:
+        document = copy.deepcopy(document)
+        labels = document.setdefault("metadata", {}).setdefault("labels", {}) or {}
+        labels[OWNING_SET_LABEL] = owning_set
+        if build_identifier is not None:
+            labels[BUILD_LABEL] = str(build_identifier)
+        document["metadata"]["labels"] = labels
+        stamped.append(document)
+    return stamped
+
+
+def _group_kind(api_version, kind):
+    group, _ = split_api_version(api_version or "")
+    return group, kind
+
+
+# Deletes objects of the owning set that are no longer part of the bundle. The
+# candidates are found with one label selector LIST per kind (and namespace)
+# and deleted in parallel.
+class Pruner:
+    def __init__(self, dynamic_client, governor, owning_set, default_namespace):
+        self.dynamic_client = dynamic_client
+        self.governor = governor
+        self.owning_set = owning_set
+        self.default_namespace = default_namespace
+
+    def list_owned(self, api_version, kind, namespaces):
+        try:
+            resource = self.dynamic_client.resources.get(
+                api_version=api_version, kind=kind
+            )
+        except ResourceNotFoundError:
+            _logger.info(f"{api_version} {kind} not served, nothing to prune")
+            return []
+
+        label_selector = f"{OWNING_SET_LABEL}={self.owning_set}"
+        owned = []
+        for namespace in sorted(namespaces) if resource.namespaced else [None]:
+            object_list = self.governor.call(
+                kind, resource.get, namespace=namespace, label_selector=label_selector
+            )
+            for item in object_list.to_dict().get("items") or []:
+                owned.append((resource, item))
+        return owned
+
+    def delete(self, resource, item, dry_run):
+        metadata = item["metadata"]
+        try:
+            self.governor.call(
+                resource.kind,
+                resource.delete,
+                name=metadata["name"],
+                namespace=metadata.get("namespace"),
+                propagation_policy="Background",
+                dry_run="All" if dry_run else None,
+            )
+        except NotFoundError:
+            return
+        _logger.info(
+            f"{'Would prune' if dry_run else 'Pruned'} {resource.kind}/{metadata['name']}"
+            f" in namespace {metadata.get('namespace')}"
+        )
+
+    # Function to prune the objects of the owning set that are not in
+    # documents. The kinds and namespaces looked at are the ones of documents,
+    # of previous_documents (the previously applied bundle) and extra_kinds, a
+    # list of (apiVersion, kind) pairs.
+    def prune(self, documents, previous_documents=None, extra_kinds=(), dry_run=False):
+        kinds = set(tuple(k) for k in extra_kinds)
+        namespaces = {self.default_namespace}
+        for document in documents + (previous_documents or []):
+            kinds.add((document.get("apiVersion"), document.get("kind")))
+            metadata = document.get("metadata") or {}
+            namespaces.add(metadata.get("namespace", self.default_namespace))
+
+        # The scope of a kind is only known from discovery, so cluster scoped
+        # objects are matched by kind and name only
+        current = set()
+        current_names = set()
+        for document in documents:
+            metadata = document.get("metadata") or {}
+            group_kind = _group_kind(document.get("apiVersion"), document.get("kind"))
+            namespace = metadata.get("namespace", self.default_namespace)
+            current.add((group_kind, namespace, metadata.get("name")))
+            current_names.add((group_kind, metadata.get("name")))
+
+        with ThreadPoolExecutor(max_workers=self.governor.limiter.maximum) as executor:
+            owned_lists = list(
+                executor.map(
+                    lambda api_version_kind: self.list_owned(
+                        *api_version_kind, namespaces
+                    ),
+                    sorted(kinds),
+                )
+            )
+
+            stale = []
+            for resource, item in (entry for owned in owned_lists for entry in owned):
+                metadata = item["metadata"]
+                group_kind = _group_kind(resource.group_version, resource.kind)
+                if resource.namespaced:
+                    in_bundle = (
+                        group_kind,
+                        metadata.get("namespace"),
+                        metadata["name"],
+                    ) in current
+                else:
+                    in_bundle = (group_kind, metadata["name"]) in current_names
+                if in_bundle:
+                    continue
+                annotations = metadata.get("annotations") or {}
+                if annotations.get(PROTECTED_ANNOTATION) == "true":
+                    _logger.info(
+                        f"Not pruning protected {resource.kind}/{metadata['name']}"
+                    )
+                    continue
+                stale.append((resource, item))
+
+            _logger.info(
+                f"Found {len(stale)} stale objects in {len(kinds)} kinds{' (dry run)' if dry_run else ''}"
+            )
+            list(executor.map(lambda entry: self.delete(*entry, dry_run), stale))
+
+        if not dry_run:
+            metrics.inc_counter(
+                "kube_pico_cd_pruned_objects_total",
+                len(stale),
+                "Number of objects deleted because they disappeared from the bundle",
+            )
+        return stale
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+
+from kube_pico_cd.metrics import metrics
+from kubernetes.client.exceptions import ApiException
+
+_logger = logging.getLogger(__name__)
+
+
+# Messages of kubectl when it gave up on requests throttled by the API server
+THROTTLED_ERRORS = (
+    "TooManyRequests",
+    "the server has received too many requests",
+)
+
+
+class Throttled(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_throttled_error(stderr):
+    return any(error in stderr for error in THROTTLED_ERRORS)
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Token bucket refilled at qps tokens per second up to burst tokens. Priority
+# callers may take a token on credit, which delays the other callers instead.
+class TokenBucket:
+    def __init__(self, qps, burst):
+        self.qps = float(qps)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, priority=False):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.qps
+                )
+                self.updated_at = now
+                if self.tokens >= 1 or priority:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.qps
+            time.sleep(wait_seconds)
+
+
+# Concurrency limit with additive increase and multiplicative decrease. The
+# limit grows by about one per limit successful requests below the latency
+# target, and shrinks on throttling and on requests above the latency target.
+# Successes without a latency sample only grow the limit.
+# Waiting priority callers are admitted before all others.
+class AimdLimiter:
+    def __init__(
+        self,
+        initial,
+        minimum,
+        maximum,
+        latency_target,
+        decrease_factor=0.5,
+        latency_decrease_factor=0.9,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.latency_decrease_factor = latency_decrease_factor
+        self.in_flight = 0
+        # Callers blocked in acquire, and the priority callers among them
+        self.waiting = 0
+        self.priority_waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=False):
+        with self.condition:
+            self.waiting += 1
+            if priority:
+                self.priority_waiting += 1
+            try:
+                while self.in_flight >= int(self.limit) or (
+                    not priority and self.priority_waiting > 0
+                ):
+                    self.condition.wait()
+            finally:
+                self.waiting -= 1
+                if priority:
+                    self.priority_waiting -= 1
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def set_limit(self, limit, reason):
+        with self.condition:
+            previous = int(self.limit)
+            self.limit = max(self.minimum, min(self.maximum, limit))
+            if int(self.limit) != previous:
+                _logger.info(
+                    f"Concurrency limit {previous} -> {int(self.limit)} ({reason})"
+                )
+            metrics.set_gauge(
+                "kube_pico_cd_api_concurrency_limit",
+                int(self.limit),
+                "Current adaptive concurrency limit against the API server",
+            )
+            self.condition.notify_all()
+
+    def on_success(self, latency=None):
+        if latency is not None and latency > self.latency_target:
+            self.set_limit(self.limit * self.latency_decrease_factor, "high latency")
+        else:
+            self.set_limit(self.limit + 1 / self.limit, "success")
+
+    def on_throttled(self):
+        self.set_limit(self.limit * self.decrease_factor, "throttled")
+
+
+# Governs the requests of the apply stage against the API server: a token
+# bucket per kind (api_qps/api_burst, overridable per kind in
+# api_rate_limits), an adaptive concurrency limit, and a global pause when the
+# API server asks to retry later.
+class ApiGovernor:
+    def __init__(self, settings):
+        self.settings = settings
+        self.default_qps = float(settings.get("api_qps", 200))
+        self.default_burst = float(settings.get("api_burst", 400))
+        self.kind_limits = settings.get("api_rate_limits", {}) or {}
+        self.max_retries = int(settings.get("api_max_retries", 5))
+        self.limiter = AimdLimiter(
+            initial=int(settings.get("apply_concurrency", 4)),
+            minimum=1,
+            maximum=int(settings.get("apply_concurrency_max", 16)),
+            latency_target=float(settings.get("api_latency_target_seconds", 1.0)),
+        )
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+
+    def bucket(self, kind):
+        with self.lock:
+            if kind not in self.buckets:
+                limits = self.kind_limits.get(kind) or {}
+                self.buckets[kind] = TokenBucket(
+                    limits.get("qps", self.default_qps),
+                    limits.get("burst", self.default_burst),
+                )
+            return self.buckets[kind]
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_for_pause(self):
+        while True:
+            with self.lock:
+                remaining = self.paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    # Function to call fn under the rate and concurrency limits. kinds lists
+    # the kind of every request fn makes; a token is taken for each of them.
+    # Throttled calls are retried after Retry-After or an exponential backoff.
+    # The duration of fn is a latency sample for the concurrency limit only if
+    # measure_latency is set and the call is not a priority write, so that
+    # calls doing more than single API requests (kubectl processes) shrink
+    # the limit on throttling only.
+    def call(self, kinds, fn, *args, priority=False, measure_latency=True, **kwargs):
+        if isinstance(kinds, str):
+            kinds = [kinds]
+        for attempt in range(self.max_retries + 1):
+            if not priority:
+                self.wait_for_pause()
+            for kind in kinds:
+                self.bucket(kind).acquire(priority)
+            self.limiter.acquire(priority)
+            start_time = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+                if measure_latency and not priority:
+                    self.limiter.on_success(time.monotonic() - start_time)
+                else:
+                    self.limiter.on_success()
+                return result
+            except (Throttled, ApiException) as e:
+                if isinstance(e, ApiException):
+                    if e.status != 429:
+                        raise
+                    retry_after = parse_retry_after(
+                        (e.headers or {}).get("Retry-After")
+                    )
+                else:
+                    retry_after = e.retry_after
+                self.limiter.on_throttled()
+                metrics.inc_counter(
+                    "kube_pico_cd_api_throttled_total",
+                    1,
+                    "Number of requests throttled by the API server",
+                )
+                if attempt == self.max_retries:
+                    raise
+                backoff = retry_after if retry_after is not None else 2**attempt
+                _logger.warning(
+                    f"Throttled by the API server, retrying in {backoff:.1f}s (attempt {attempt + 1})"
+                )
+                self.pause(backoff)
+                if priority:
+                    time.sleep(backoff)
+            finally:
+                self.limiter.release()
@@ -0,0 +1,224 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from kube_pico_cd.manifests import document_key
+from kube_pico_cd.metrics import metrics
+from kubernetes import watch as kube_watch
+from kubernetes.client.exceptions import ApiException
+
+_logger = logging.getLogger(__name__)
+
+
+# Workload kinds whose rollout is tracked, and the name of the AppsV1Api method
+# that lists (and watches) them
+TRACKED_KINDS = {
+    "Deployment": "list_namespaced_deployment",
+    "StatefulSet": "list_namespaced_stateful_set",
+    "DaemonSet": "list_namespaced_daemon_set",
+}
+
+
+def _observed_current_generation(obj):
+    status = obj.get("status") or {}
+    generation = (obj.get("metadata") or {}).get("generation", 0)
+    return status.get("observedGeneration", 0) >= generation
+
+
+# Function to check whether a workload has rolled out its current generation,
+# following the conditions of kubectl rollout status
+def is_ready(kind, obj):
+    if not _observed_current_generation(obj):
+        return False
+    spec = obj.get("spec") or {}
+    status = obj.get("status") or {}
+
+    if kind == "Deployment":
+        replicas = spec.get("replicas", 1)
+        updated = status.get("updatedReplicas", 0)
+        return (
+            updated >= replicas
+            and status.get("replicas", 0) <= updated
+            and status.get("availableReplicas", 0) >= updated
+        )
+    if kind == "StatefulSet":
+        replicas = spec.get("replicas", 1)
+        if status.get("readyReplicas", 0) < replicas:
+            return False
+        if (spec.get("updateStrategy") or {}).get(
+            "type", "RollingUpdate"
+        ) != "RollingUpdate":
+            return True
+        return status.get("updatedReplicas", 0) >= replicas
+    if kind == "DaemonSet":
+        desired = status.get("desiredNumberScheduled", 0)
+        return (
+            status.get("updatedNumberScheduled", 0) >= desired
+            and status.get("numberAvailable", 0) >= desired
+        )
+    return True
+
+
+# Watches are reopened at least this often, so that tracking stops soon after
+# a stop is requested
+WATCH_SEGMENT_SECONDS = 10
+
+
+# Tracks the rollout of the workloads of a bundle after an apply, with one
+# watch per kind and namespace for all of the bundle's workloads
+class RolloutTracker:
+    def __init__(self, apps_api, default_namespace, timeout_seconds):
+        self.apps_api = apps_api
+        self.default_namespace = default_namespace
+        self.timeout_seconds = timeout_seconds
+
+    def wait_for_kind(
+        self, kind, namespace, names, start_time, deadline, stop_event=None
+    ):
+        list_method = getattr(self.apps_api, TRACKED_KINDS[kind])
+        pending = set(names)
+        ready_times = {}
+
+        def check(obj):
+            name = (obj.get("metadata") or {}).get("name")
+            if name in pending and is_ready(kind, obj):
+                pending.discard(name)
+                ready_times[name] = time.monotonic() - start_time
+
+        resource_version = None
+        while pending and time.monotonic() < deadline:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if resource_version is None:
+                response = list_method(namespace, _preload_content=False)
+                object_list = json.loads(response.data)
+                for obj in object_list.get("items") or []:
+                    check(obj)
+                resource_version = object_list["metadata"]["resourceVersion"]
+                continue
+
+            watcher = kube_watch.Watch()
+            try:
+                for event in watcher.stream(
+                    list_method,
+                    namespace,
+                    resource_version=resource_version,
+                    timeout_seconds=max(
+                        1, min(WATCH_SEGMENT_SECONDS, int(deadline - time.monotonic()))
+                    ),
+                ):
+                    obj = event["raw_object"]
+                    if event["type"] == "ERROR":
+                        # most likely 410 Gone, start over with a fresh list
+                        resource_version = None
+                        break
+                    resource_version = obj["metadata"]["resourceVersion"]
+                    check(obj)
+                    if not pending:
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                resource_version = None
+            except urllib3.exceptions.HTTPError as e:
+                # Dropped connection or timeout, watch again from the last
+                # resource version
+                _logger.info(f"Watch of {kind} in namespace {namespace} failed: {e}")
+                time.sleep(1)
+            finally:
+                watcher.stop()
+
+        return ready_times, pending
+
+    def track(self, documents, build_identifier, start_time=None, stop_event=None):
+        if start_time is None:
+            start_time = time.monotonic()
+        deadline = time.monotonic() + self.timeout_seconds
+
+        workloads = {}
+        for document in documents:
+            if document.get("kind") in TRACKED_KINDS:
+                _, kind, namespace, name = document_key(
+                    document, self.default_namespace
+                )
+                workloads.setdefault((kind, namespace), []).append(name)
+        if not workloads:
+            return {}
+
+        ready_times = {}
+        timed_out = []
+        lock = threading.Lock()
+
+        def wait(group):
+            kind, namespace = group
+            try:
+                ready, pending = self.wait_for_kind(
+                    kind,
+                    namespace,
+                    workloads[group],
+                    start_time,
+                    deadline,
+                    stop_event,
+                )
+            except Exception as e:
+                _logger.warning(f"Failed to watch {kind} in namespace {namespace}: {e}")
+                ready, pending = {}, workloads[group]
+            with lock:
+                for name, seconds in ready.items():
+                    ready_times[(kind, namespace, name)] = seconds
+                timed_out.extend((kind, namespace, name) for name in pending)
+
+        with ThreadPoolExecutor(max_workers=len(workloads)) as executor:
+            list(executor.map(wait, workloads))
+
+        for (kind, namespace, name), seconds in sorted(ready_times.items()):
+            _logger.info(
+                f"{kind}/{name} in namespace {namespace} ready after {seconds:.1f}s"
+            )
+            metrics.set_gauge(
+                "kube_pico_cd_workload_time_to_ready_seconds",
+                seconds,
+                "Time from the start of the apply until the workload was ready",
+                {"kind": kind, "namespace": namespace, "name": name},
+            )
+        if stop_event is not None and stop_event.is_set():
+            # Stopped by a shutdown or a newer build, pending workloads did
+            # not time out
+            _logger.info(
+                f"Stopped tracking build {build_identifier}, {len(timed_out)} workloads not ready yet"
+            )
+            return ready_times
+
+        for kind, namespace, name in sorted(timed_out):
+            _logger.warning(
+                f"{kind}/{name} in namespace {namespace} not ready after {self.timeout_seconds}s"
+            )
+        metrics.inc_counter(
+            "kube_pico_cd_rollout_timeouts_total",
+            len(timed_out),
+            "Number of workloads that did not become ready within the rollout timeout",
+        )
+
+        if timed_out:
+            _logger.warning(
+                f"Build {build_identifier}: {len(timed_out)} of {len(ready_times) + len(timed_out)} workloads not ready"
+            )
+        else:
+            build_seconds = max(ready_times.values())
+            _logger.info(
+                f"Build {build_identifier}: all {len(ready_times)} workloads ready after {build_seconds:.1f}s"
+            )
+            metrics.observe(
+                "kube_pico_cd_build_time_to_ready_seconds",
+                build_seconds,
+                "Time from the start of the apply until all workloads of a build were ready",
+            )
+            metrics.set_gauge(
+                "kube_pico_cd_last_build_time_to_ready_seconds",
+                build_seconds,
+                "Time to ready of the last build whose workloads all became ready",
+            )
+        return ready_times
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kube_pico_cd.metrics import metrics
+
+_logger = logging.getLogger(__name__)
+
+
+# Liveness and readiness of the listener. The listener loop calls beat()
+# regularly; it is alive as long as the last beat is more recent than
+# liveness_timeout seconds, and ready while it receives messages.
+class Health:
+    def __init__(self):
+        self.last_beat = time.monotonic()
+        self.ready = False
+        self.liveness_timeout = 900
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+
+    def set_ready(self, ready):
+        self.ready = ready
+
+    def is_alive(self):
+        return time.monotonic() - self.last_beat < self.liveness_timeout
+
+
+health = Health()
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.respond(200, metrics.render(), "text/plain; version=0.0.4")
+        elif self.path == "/healthz":
+            if health.is_alive():
+                self.respond(200, "ok\n")
+            else:
+                self.respond(503, "listener loop stalled\n")
+        elif self.path == "/readyz":
+            if health.ready:
+                self.respond(200, "ok\n")
+            else:
+                self.respond(503, "not ready\n")
+        else:
+            self.respond(404, "not found\n")
+
+    def respond(self, status, body, content_type="text/plain"):
+        content = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        _logger.debug(format % args)
+
+
+# Function to serve the status endpoints in a background thread
+def start_status_server(port):
+    server = ThreadingHTTPServer(("", port), StatusRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _logger.info(f"Serving status endpoints on port {port}")
+    return server
@@ -0,0 +1,282 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+import boto3
+
+_logger = logging.getLogger(__name__)
+
+
+# The handle of a message may change when it is received again, its
+# message_id stays the same across redeliveries
+@dataclass
+class QueueMessage:
+    body: str
+    handle: object = None
+    message_id: str = None
+
+
+# Interface of the queue transports used by the deployer and the listener
+class QueueTransport:
+    def send(self, body):
+        raise NotImplementedError
+
+    # Receive up to max_messages messages, waiting at most wait_seconds for the
+    # first one. Received messages stay invisible to other consumers until they
+    # are acknowledged or their visibility timeout expires.
+    def receive_batch(self, max_messages=1, wait_seconds=20):
+        raise NotImplementedError
+
+    def ack(self, message):
+        raise NotImplementedError
+
+    # Extend the visibility timeout of a received message. A timeout of 0
+    # releases the message so that it can be received again immediately.
+    def extend_visibility(self, message, timeout_seconds):
+        raise NotImplementedError
+
+
+class SqsTransport(QueueTransport):
+    def __init__(self, queue_name, visibility_timeout=None):
+        sqs = boto3.resource("sqs")
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        self.queue = sqs.get_queue_by_name(QueueName=queue_name)
+
+    def send(self, body):
+        self.queue.send_message(MessageBody=body)
+
+    def receive_batch(self, max_messages=1, wait_seconds=20):
+        options = {}
+        if self.visibility_timeout is not None:
+            # Otherwise the default visibility timeout of the queue applies
+            options["VisibilityTimeout"] = int(self.visibility_timeout)
+        return [
+            QueueMessage(message.body, message, message.message_id)
+            for message in self.queue.receive_messages(
+                MaxNumberOfMessages=max_messages,
+                WaitTimeSeconds=wait_seconds,
+                **options,
+            )
+        ]
+
+    def ack(self, message):
+        message.handle.delete()
+
+    def extend_visibility(self, message, timeout_seconds):
+        message.handle.change_visibility(VisibilityTimeout=int(timeout_seconds))
+
+
+# Wakes up a waiting consumer when a file is moved into a directory. Uses
+# inotify where available and falls back to polling otherwise.
+class DirectoryWatcher:
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, directory):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if (
+                libc.inotify_add_watch(
+                    fd, str(directory).encode(), self.IN_MOVED_TO | self.IN_CREATE
+                )
+                < 0
+            ):
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (AttributeError, OSError, TypeError) as e:
+            _logger.info(f"inotify not available, polling {directory}: {e}")
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+# Queue transport on a local directory. Messages are files that move between
+# the tmp, new and inflight subdirectories by atomic renames; the modification
+# time of an inflight file is its visibility deadline.
+class SpoolTransport(QueueTransport):
+    def __init__(self, directory, visibility_timeout=300):
+        self.directory = Path(directory)
+        self.visibility_timeout = visibility_timeout
+        self.tmp_dir = self.directory / "tmp"
+        self.new_dir = self.directory / "new"
+        self.inflight_dir = self.directory / "inflight"
+        for subdirectory in (self.tmp_dir, self.new_dir, self.inflight_dir):
+            subdirectory.mkdir(parents=True, exist_ok=True)
+        self.watcher = None
+
+    def send(self, body):
+        # Names sort in send order, so that messages are received FIFO
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+        tmp_path = self.tmp_dir / name
+        with open(tmp_path, "w") as file:
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(tmp_path, self.new_dir / name)
+
+    def requeue_expired(self):
+        now = time.time()
+        for path in self.inflight_dir.iterdir():
+            try:
+                if path.stat().st_mtime <= now:
+                    os.rename(path, self.new_dir / path.name)
+                    _logger.info(f"Visibility timeout of {path.name} expired")
+            except FileNotFoundError:
+                # acknowledged or requeued by another consumer
+                pass
+
+    def claim(self, max_messages):
+        messages = []
+        for name in sorted(os.listdir(self.new_dir)):
+            inflight_path = self.inflight_dir / name
+            # The deadline is set before the rename, so that the file never
+            # appears expired in the inflight directory
+            deadline = time.time() + self.visibility_timeout
+            try:
+                os.utime(self.new_dir / name, (deadline, deadline))
+                os.rename(self.new_dir / name, inflight_path)
+            except FileNotFoundError:
+                # claimed by another consumer
+                continue
+            with open(inflight_path, "r") as file:
+                messages.append(QueueMessage(file.read(), name, name))
+            if len(messages) >= max_messages:
+                break
+        return messages
+
+    def receive_batch(self, max_messages=1, wait_seconds=20):
+        if self.watcher is None:
+            self.watcher = DirectoryWatcher(self.new_dir)
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            self.requeue_expired()
+            messages = self.claim(max_messages)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            self.watcher.wait(remaining)
+
+    def ack(self, message):
+        try:
+            os.remove(self.inflight_dir / message.handle)
+        except FileNotFoundError:
+            _logger.warning(f"Message {message.handle} was no longer in flight")
+
+    def extend_visibility(self, message, timeout_seconds):
+        inflight_path = self.inflight_dir / message.handle
+        try:
+            if timeout_seconds <= 0:
+                os.rename(inflight_path, self.new_dir / message.handle)
+                return
+            deadline = time.time() + timeout_seconds
+            os.utime(inflight_path, (deadline, deadline))
+        except FileNotFoundError:
+            _logger.warning(f"Message {message.handle} was no longer in flight")
+
+
+# Queue transport on a Redis stream with a consumer group. Pending entries that
+# have been idle for longer than the visibility timeout are claimed again.
+class RedisStreamsTransport(QueueTransport):
+    GROUP_NAME = "kube-pico-cd"
+
+    def __init__(self, url, stream_name, visibility_timeout=300):
+        try:
+            import redis
+        except ImportError as e:
+            raise Exception(
+                "The redis queue transport requires the redis package, install kube-pico-cd[redis]"
+            ) from e
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.stream_name = stream_name
+        self.visibility_timeout = visibility_timeout
+        self.consumer_name = f"{os.uname().nodename}-{os.getpid()}"
+        try:
+            self.redis.xgroup_create(
+                stream_name, self.GROUP_NAME, id="0", mkstream=True
+            )
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def send(self, body):
+        self.redis.xadd(self.stream_name, {"body": body})
+
+    def receive_batch(self, max_messages=1, wait_seconds=20):
+        _, entries, *_ = self.redis.xautoclaim(
+            self.stream_name,
+            self.GROUP_NAME,
+            self.consumer_name,
+            min_idle_time=int(self.visibility_timeout * 1000),
+            count=max_messages,
+        )
+        if not entries:
+            response = self.redis.xreadgroup(
+                self.GROUP_NAME,
+                self.consumer_name,
+                {self.stream_name: ">"},
+                count=max_messages,
+                block=int(wait_seconds * 1000),
+            )
+            entries = [
+                entry for _, stream_entries in response for entry in stream_entries
+            ]
+        return [
+            QueueMessage(fields["body"], entry_id, entry_id)
+            for entry_id, fields in entries
+            if fields is not None
+        ]
+
+    def ack(self, message):
+        self.redis.xack(self.stream_name, self.GROUP_NAME, message.handle)
+        self.redis.xdel(self.stream_name, message.handle)
+
+    def extend_visibility(self, message, timeout_seconds):
+        # The visibility of a pending entry is given by its idle time, claiming
+        # it with a preset idle time moves its visibility deadline
+        idle = max(0, self.visibility_timeout - timeout_seconds)
+        self.redis.xclaim(
+            self.stream_name,
+            self.GROUP_NAME,
+            self.consumer_name,
+            min_idle_time=0,
+            message_ids=[message.handle],
+            idle=int(idle * 1000),
+        )
+
+
+def create_transport(settings, queue_name):
+    transport = settings.get("queue_transport", "sqs")
+    visibility_timeout = int(settings.get("visibility_timeout", 300))
+    _logger.info(f"Using {transport} queue transport for queue {queue_name}")
+    if transport == "sqs":
+        return SqsTransport(queue_name, visibility_timeout)
+    if transport == "spool":
+        return SpoolTransport(
+            Path(settings.spool_directory) / queue_name, visibility_timeout
+        )
+    if transport == "redis":
+        return RedisStreamsTransport(settings.redis_url, queue_name, visibility_timeout)
+    raise Exception(f"Unknown queue transport {transport}")
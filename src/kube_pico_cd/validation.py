@@ -0,0 +1,249 @@
+import functools
+import json
+import logging
+import os
+import tempfile
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import jsonschema
+import yaml
+from kube_pico_cd.manifests import describe_document, split_api_version
+
+_logger = logging.getLogger(__name__)
+
+
+# Below this number of documents, validation runs in the calling process, as
+# starting worker processes would take longer than validating
+PARALLEL_VALIDATION_THRESHOLD = 50
+
+MAX_ERRORS_PER_DOCUMENT = 10
+
+# Suffix of the cache entries that record a schema as not published
+NOT_PUBLISHED_SUFFIX = ".not-published"
+
+
+# Raised when a schema could not be fetched for another reason than not being
+# published, for example without network access
+class SchemaFetchError(Exception):
+    pass
+
+
+# File name of a schema in the kubernetes-json-schema layout, for example
+# deployment-apps-v1.json or configmap-v1.json
+def schema_file_name(api_version, kind):
+    group, version = split_api_version(api_version)
+    if group:
+        return f"{kind.lower()}-{group.split('.')[0]}-{version}.json"
+    return f"{kind.lower()}-{version}.json"
+
+
+# File name of the schema of a CRD version. Unlike in schema_file_name, the
+# group is kept in full, as the groups of different CRDs often share their
+# first segment.
+def crd_schema_file_name(api_version, kind):
+    group, version = split_api_version(api_version)
+    return f"{kind.lower()}-{group}-{version}.json"
+
+
+@functools.lru_cache(maxsize=None)
+def load_validator(schema_path):
+    with open(schema_path, "r") as file:
+        schema = json.load(file)
+    validator_class = jsonschema.validators.validator_for(schema)
+    return validator_class(schema)
+
+
+def validate_document(item):
+    document, schema_path = item
+    validator = load_validator(schema_path)
+    errors = sorted(validator.iter_errors(document), key=lambda e: list(e.path))
+    return [
+        f"{describe_document(document)}: {'.'.join(str(p) for p in error.absolute_path) or '<root>'}: {error.message}"
+        for error in errors[:MAX_ERRORS_PER_DOCUMENT]
+    ]
+
+
+# Validates manifests against Kubernetes OpenAPI schemas in the
+# kubernetes-json-schema format. Schemas are fetched once from schema_location
+# (a URL or a local directory) and kept in schema_cache_dir, so that
+# validation works offline once the cache is filled, for example with the
+# fetch_schemas sub-command. Schemas that are not published (HTTP 404) are
+# remembered as such; other fetch failures are errors unless
+# validation_allow_fetch_failures is set. CRD schemas are taken from
+# CustomResourceDefinitions in the bundle and in crd_paths on every
+# validation, and are not cached.
+class SchemaValidator:
+    def __init__(self, settings, crd_paths=None):
+        self.kubernetes_version = settings.get("kubernetes_version", "master")
+        self.schema_location = settings.schema_location.format(
+            kubernetes_version=self.kubernetes_version
+        )
+        if "://" not in self.schema_location:
+            self.schema_location = (
+                Path(os.path.expanduser(self.schema_location)).resolve().as_uri()
+            )
+        self.cache_dir = (
+            Path(os.path.expanduser(settings.schema_cache_dir))
+            / self.kubernetes_version
+        )
+        self.ignore_missing_schemas = settings.get(
+            "validation_ignore_missing_schemas", True
+        )
+        self.allow_fetch_failures = settings.get(
+            "validation_allow_fetch_failures", False
+        )
+        self.fetch_timeout = float(settings.get("schema_fetch_timeout_seconds", 10))
+        self.workers = int(settings.get("validation_workers", 0)) or os.cpu_count()
+        self.crd_paths = crd_paths or []
+
+    # Function to write the schemas of the CustomResourceDefinitions among
+    # documents to crd_dir. Returns their paths by file name.
+    def register_crds(self, documents, crd_dir):
+        crd_schemas = {}
+        for document in documents:
+            if document.get("kind") != "CustomResourceDefinition":
+                continue
+            spec = document.get("spec") or {}
+            group = spec.get("group", "")
+            kind = (spec.get("names") or {}).get("kind", "")
+            for version in spec.get("versions") or []:
+                schema = (version.get("schema") or {}).get("openAPIV3Schema")
+                if not schema:
+                    continue
+                file_name = crd_schema_file_name(f"{group}/{version['name']}", kind)
+                path = Path(crd_dir) / file_name
+                with open(path, "w") as file:
+                    json.dump(schema, file)
+                crd_schemas[file_name] = path
+        return crd_schemas
+
+    def load_crd_files(self):
+        documents = []
+        for crd_path in self.crd_paths:
+            crd_path = Path(crd_path)
+            files = (
+                sorted(crd_path.rglob("*.yaml")) if crd_path.is_dir() else [crd_path]
+            )
+            for file_path in files:
+                with open(file_path, "r") as file:
+                    documents.extend(d for d in yaml.safe_load_all(file) if d)
+        return documents
+
+    # Function to fetch a schema into the cache. Returns its path, or None if
+    # the schema is not published, which is cached as well.
+    def fetch_schema(self, file_name):
+        path = self.cache_dir / file_name
+        url = f"{self.schema_location}/{file_name}"
+        try:
+            with urllib.request.urlopen(url, timeout=self.fetch_timeout) as response:
+                content = response.read()
+        except (urllib.error.URLError, OSError) as e:
+            not_published = (
+                isinstance(e, urllib.error.HTTPError) and e.code == 404
+            ) or isinstance(getattr(e, "reason", None), FileNotFoundError)
+            if not not_published:
+                raise SchemaFetchError(f"Failed to fetch schema {url}: {e}")
+            (self.cache_dir / f"{file_name}{NOT_PUBLISHED_SUFFIX}").touch()
+            _logger.info(f"Schema {url} is not published")
+            return None
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        _logger.info(f"Cached schema {url}")
+        return path
+
+    # Function to get the file name of the schema of a document, among the
+    # registered CRD schemas or in the kubernetes-json-schema layout
+    @staticmethod
+    def document_schema_name(document, crd_schemas):
+        api_version = document.get("apiVersion", "")
+        kind = document.get("kind", "")
+        file_name = crd_schema_file_name(api_version, kind)
+        if file_name in crd_schemas:
+            return file_name
+        return schema_file_name(api_version, kind)
+
+    # Function to find the schema file of every document, fetching the ones
+    # that are not cached yet. Returns the schema paths and the fetch errors,
+    # both by file name.
+    def resolve_schemas(self, documents, crd_schemas=None):
+        crd_schemas = crd_schemas or {}
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        schema_paths = {}
+        missing = set()
+        for document in documents:
+            file_name = self.document_schema_name(document, crd_schemas)
+            if file_name in crd_schemas:
+                schema_paths[file_name] = crd_schemas[file_name]
+            elif (self.cache_dir / file_name).exists():
+                schema_paths[file_name] = self.cache_dir / file_name
+            elif not (self.cache_dir / f"{file_name}{NOT_PUBLISHED_SUFFIX}").exists():
+                missing.add(file_name)
+
+        fetch_errors = {}
+
+        def fetch(file_name):
+            try:
+                return self.fetch_schema(file_name)
+            except SchemaFetchError as e:
+                fetch_errors[file_name] = str(e)
+                return None
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for file_name, path in zip(
+                    sorted(missing), executor.map(fetch, sorted(missing))
+                ):
+                    if path is not None:
+                        schema_paths[file_name] = path
+        return schema_paths, fetch_errors
+
+    def validate(self, documents):
+        # CRD schemas are written to a fresh directory, so that CRDs removed
+        # from the bundle or crd_paths are not used any longer
+        with tempfile.TemporaryDirectory(prefix="kube-pico-cd-crds-") as crd_dir:
+            crd_schemas = self.register_crds(self.load_crd_files() + documents, crd_dir)
+            return self.validate_with_crds(documents, crd_schemas)
+
+    def validate_with_crds(self, documents, crd_schemas):
+        schema_paths, fetch_errors = self.resolve_schemas(documents, crd_schemas)
+
+        errors = []
+        for file_name, fetch_error in sorted(fetch_errors.items()):
+            if self.allow_fetch_failures:
+                _logger.warning(f"{fetch_error}, skipping validation")
+            else:
+                errors.append(fetch_error)
+        items = []
+        for document in documents:
+            file_name = self.document_schema_name(document, crd_schemas)
+            if file_name in schema_paths:
+                items.append((document, str(schema_paths[file_name])))
+            elif file_name in fetch_errors:
+                continue
+            elif self.ignore_missing_schemas:
+                _logger.warning(
+                    f"No schema for {document.get('apiVersion')} {describe_document(document)}, skipping validation"
+                )
+            else:
+                errors.append(
+                    f"{describe_document(document)}: no schema for {document.get('apiVersion')}"
+                )
+
+        if len(items) < PARALLEL_VALIDATION_THRESHOLD or self.workers <= 1:
+            results = map(validate_document, items)
+            errors += [e for result in results for e in result]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                chunksize = max(1, len(items) // (self.workers * 4))
+                results = executor.map(validate_document, items, chunksize=chunksize)
+                errors += [e for result in results for e in result]
+
+        _logger.info(
+            f"Validated {len(items)} of {len(documents)} documents, {len(errors)} errors"
+        )
+        return errors
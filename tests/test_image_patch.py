@@ -0,0 +1,143 @@
+import copy
+
+from dynaconf import Dynaconf
+from kube_pico_cd.config import settings_path
+from kube_pico_cd.image_patch import (
+    STRATEGIC_MERGE_PATCH,
+    find_image_only_changes,
+    patch_images,
+)
+from kube_pico_cd.listener import Listener
+
+CONFIG_MAP_NAME = "kube-pico-cd-build-info"
+
+
+def deployment(image="app:1", sidecar_image="proxy:1", replicas=1):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": "app"},
+        "spec": {
+            "replicas": replicas,
+            "template": {
+                "spec": {
+                    "initContainers": [{"name": "init", "image": "init:1"}],
+                    "containers": [
+                        {"name": "app", "image": image},
+                        {"name": "proxy", "image": sidecar_image},
+                    ],
+                }
+            },
+        },
+    }
+
+
+def build_info(build):
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": CONFIG_MAP_NAME},
+        "data": {"BUILD_TIMESTAMP": str(build)},
+    }
+
+
+def test_image_only_change_lists_changed_containers():
+    previous = [deployment(), build_info(1)]
+    documents = [deployment(image="app:2"), build_info(2)]
+
+    changes = find_image_only_changes(previous, documents, CONFIG_MAP_NAME)
+
+    assert changes == [
+        (documents[0], {"containers": [{"name": "app", "image": "app:2"}]})
+    ]
+
+
+def test_unchanged_bundle_has_nothing_to_patch():
+    previous = [deployment(), build_info(1)]
+    documents = [deployment(), build_info(2)]
+
+    assert find_image_only_changes(previous, documents, CONFIG_MAP_NAME) == []
+
+
+def test_change_beyond_images_requires_full_apply():
+    previous = [deployment(), build_info(1)]
+    documents = [deployment(image="app:2", replicas=2), build_info(2)]
+
+    assert find_image_only_changes(previous, documents, CONFIG_MAP_NAME) is None
+
+
+def test_changed_set_of_objects_requires_full_apply():
+    previous = [deployment(), build_info(1)]
+    documents = [deployment(image="app:2")]
+
+    assert find_image_only_changes(previous, documents, CONFIG_MAP_NAME) is None
+
+
+def test_changed_non_workload_requires_full_apply():
+    config_map = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "c"}}
+    changed_config_map = copy.deepcopy(config_map)
+    changed_config_map["data"] = {"a": "b"}
+    previous = [deployment(), config_map]
+    documents = [deployment(image="app:2"), changed_config_map]
+
+    assert find_image_only_changes(previous, documents, CONFIG_MAP_NAME) is None
+
+
+# Records the calls of the patch methods of the Kubernetes client
+class StubApi:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def patch(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return patch
+
+
+def test_patch_images_sends_strategic_merge_patches():
+    apps_api = StubApi()
+    changes = [(deployment(), {"containers": [{"name": "app", "image": "app:2"}]})]
+
+    patch_images(apps_api, changes, "ns", field_manager="kube-pico-cd")
+
+    assert apps_api.calls == [
+        (
+            "patch_namespaced_deployment",
+            (
+                "app",
+                "ns",
+                {
+                    "spec": {
+                        "template": {
+                            "spec": {"containers": [{"name": "app", "image": "app:2"}]}
+                        }
+                    }
+                },
+            ),
+            {
+                "field_manager": "kube-pico-cd",
+                "_content_type": STRATEGIC_MERGE_PATCH,
+            },
+        )
+    ]
+
+
+def test_apply_image_changes_patches_workloads_before_build_info():
+    settings = Dynaconf(settings_files=[settings_path])
+    settings.set("kube_namespace", "ns")
+    listener = Listener(settings)
+    listener.apps_api = listener.kube_api = api = StubApi()
+    documents = [deployment(image="app:2"), build_info(2)]
+    changes = [(documents[0], {"containers": [{"name": "app", "image": "app:2"}]})]
+
+    listener.apply_image_changes(changes, documents)
+
+    assert [(name, args[:2]) for name, args, _ in api.calls] == [
+        ("patch_namespaced_deployment", ("app", "ns")),
+        ("patch_namespaced_config_map", (CONFIG_MAP_NAME, "ns")),
+    ]
+    assert api.calls[1][1][2] == {"data": {"BUILD_TIMESTAMP": "2"}}
+    assert all(
+        kwargs["_content_type"] == STRATEGIC_MERGE_PATCH for _, _, kwargs in api.calls
+    )
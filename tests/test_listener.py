@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+
+import pytest
+from dynaconf import Dynaconf
+from kube_pico_cd.config import settings_path
+from kube_pico_cd.kubectl import ApplyCancelled, ApplyError
+from kube_pico_cd.listener import Listener
+from kube_pico_cd.transport import SpoolTransport
+
+
+# Stands in for Listener.apply_manifests. Blocking builds run until they are
+# cancelled or finished.
+class StubApply:
+    def __init__(self, listener, blocking=(), error=None):
+        self.listener = listener
+        self.blocking = blocking
+        self.error = error
+        self.finish = threading.Event()
+        self.outcomes = {}
+
+    def __call__(self, manifests, build_identifier=None):
+        if build_identifier in self.blocking:
+            cancel_event = self.listener.cancel_event
+            while not self.finish.is_set():
+                if cancel_event.wait(0.01):
+                    self.outcomes[build_identifier] = "cancelled"
+                    raise ApplyCancelled(f"Apply of {build_identifier} cancelled")
+        if self.error is not None:
+            self.outcomes[build_identifier] = "failed"
+            raise self.error
+        self.outcomes[build_identifier] = "applied"
+
+
+@pytest.fixture
+def listener():
+    settings = Dynaconf(settings_files=[settings_path])
+    settings.set("kube_namespace", "ns")
+    listener = Listener(settings)
+    listener.get_current_incremental_identifier = lambda: 0
+    return listener
+
+
+@pytest.fixture
+def transport(tmp_path):
+    return SpoolTransport(tmp_path)
+
+
+def receive_build(transport, build_identifier):
+    transport.send(
+        json.dumps(
+            {"data": {"BUILD_TIMESTAMP": str(build_identifier)}, "manifests": ""}
+        )
+    )
+    (message,) = transport.receive_batch(wait_seconds=0)
+    return message
+
+
+def pending_messages(transport):
+    return sorted(os.listdir(transport.new_dir)) + sorted(
+        os.listdir(transport.inflight_dir)
+    )
+
+
+def test_superseded_build_is_cancelled_and_acknowledged(listener, transport):
+    listener.apply_manifests = stub = StubApply(listener, blocking=[1])
+    listener.handle_message(transport, receive_build(transport, 1))
+
+    listener.handle_message(transport, receive_build(transport, 2))
+    listener.finish_apply(transport)
+
+    assert stub.outcomes == {1: "cancelled", 2: "applied"}
+    assert pending_messages(transport) == []
+
+
+def test_in_flight_message_is_released_on_shutdown(listener, transport):
+    listener.apply_manifests = stub = StubApply(listener, blocking=[1])
+    message = receive_build(transport, 1)
+    listener.handle_message(transport, message)
+
+    listener.shutdown()
+    listener.finish_apply(transport)
+
+    assert stub.outcomes == {1: "cancelled"}
+    assert [m.body for m in transport.receive_batch(wait_seconds=0)] == [message.body]
+
+
+def test_failed_apply_is_released_on_shutdown(listener, transport):
+    listener.apply_manifests = StubApply(listener, error=Exception("boom"))
+    listener.shutting_down.set()
+    listener.start_apply(receive_build(transport, 1), "", 1)
+
+    listener.finish_apply(transport)
+
+    assert len(transport.receive_batch(wait_seconds=0)) == 1
+
+
+def test_redelivered_in_flight_message_is_not_deleted(listener, transport):
+    listener.apply_manifests = stub = StubApply(listener, blocking=[1])
+    message = receive_build(transport, 1)
+    listener.handle_message(transport, message)
+
+    # The visibility timeout of the in-flight message expires
+    os.utime(transport.inflight_dir / message.handle, (0, 0))
+    (redelivered,) = transport.receive_batch(wait_seconds=0)
+    listener.handle_message(transport, redelivered)
+
+    assert pending_messages(transport) == [message.handle]
+    assert listener.in_flight.message is redelivered
+    stub.finish.set()
+    listener.finish_apply(transport)
+    assert stub.outcomes == {1: "applied"}
+    assert pending_messages(transport) == []
+
+
+def test_failed_apply_is_not_acknowledged(listener, transport):
+    listener.apply_manifests = StubApply(listener, error=ApplyError("failed"))
+    message = receive_build(transport, 1)
+    listener.handle_message(transport, message)
+
+    listener.finish_apply(transport)
+
+    assert listener.in_flight is None
+    assert pending_messages(transport) == [message.handle]
+    assert transport.receive_batch(wait_seconds=0) == []
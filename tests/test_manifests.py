@@ -0,0 +1,72 @@
+import yaml
+from kube_pico_cd.manifests import chunk_documents, parse_documents
+
+
+def config_map(name, data_size=1):
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": name},
+        "data": {"value": "x" * data_size},
+    }
+
+
+def test_parse_documents_flattens_lists_and_skips_empty_documents():
+    manifests = """
+---
+apiVersion: v1
+kind: List
+items:
+- {apiVersion: v1, kind: ConfigMap, metadata: {name: a}}
+- {apiVersion: v1, kind: ConfigMap, metadata: {name: b}}
+---
+---
+apiVersion: v1
+kind: Namespace
+metadata: {name: ns}
+"""
+    documents = parse_documents(manifests)
+    assert [d["metadata"]["name"] for d in documents] == ["a", "b", "ns"]
+
+
+def test_chunk_documents_applies_ordering_sensitive_kinds_first():
+    namespace = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "n"}}
+    crd = {
+        "apiVersion": "apiextensions.k8s.io/v1",
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": "foos.example.com"},
+    }
+    documents = [config_map("a"), namespace, config_map("b"), crd]
+
+    ordered, chunks = chunk_documents(documents, max_objects=10, max_bytes=10**6)
+
+    assert ordered == [namespace, crd]
+    assert chunks == [[config_map("a"), config_map("b")]]
+
+
+def test_chunk_documents_bounds_object_count():
+    documents = [config_map(f"c{i}") for i in range(7)]
+
+    _, chunks = chunk_documents(documents, max_objects=3, max_bytes=10**6)
+
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [d for chunk in chunks for d in chunk] == documents
+
+
+def test_chunk_documents_bounds_serialized_size():
+    documents = [config_map(f"c{i}", data_size=400) for i in range(4)]
+    document_bytes = len(yaml.safe_dump(documents[0]))
+
+    _, chunks = chunk_documents(
+        documents, max_objects=100, max_bytes=2 * document_bytes
+    )
+
+    assert [len(chunk) for chunk in chunks] == [2, 2]
+
+
+def test_chunk_documents_keeps_oversized_documents_in_their_own_chunk():
+    documents = [config_map("small"), config_map("big", data_size=5000)]
+
+    _, chunks = chunk_documents(documents, max_objects=100, max_bytes=1000)
+
+    assert chunks == [[documents[0]], [documents[1]]]
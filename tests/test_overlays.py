@@ -0,0 +1,210 @@
+import hashlib
+
+import pytest
+import yaml
+from kube_pico_cd.deployer import push_overlays_to_deploy_queue
+from kube_pico_cd.overlays import (
+    Overlay,
+    OverlayRenderer,
+    UndefinedVariable,
+    load_overlays,
+    strategic_merge,
+    substitute,
+)
+
+
+def test_substitute_replaces_variables_in_nested_values():
+    document = {"spec": {"image": "nginx:${TAG}", "args": ["--env=${ENV}"]}}
+
+    result = substitute(document, {"TAG": "1.25", "ENV": "dev"})
+
+    assert result == {"spec": {"image": "nginx:1.25", "args": ["--env=dev"]}}
+
+
+def test_substitute_keeps_the_type_of_a_single_variable():
+    assert substitute({"replicas": "${REPLICAS}"}, {"REPLICAS": 3}) == {"replicas": 3}
+
+
+def test_substitute_fails_on_undefined_variable():
+    with pytest.raises(UndefinedVariable, match="TAG"):
+        substitute({"image": "nginx:${TAG}"}, {})
+
+
+def test_substitute_unescapes_literal_references():
+    script = "echo $${HOME} ${ENV}"
+
+    assert substitute(script, {"ENV": "dev"}) == "echo ${HOME} dev"
+    assert substitute("$${HOME}", {}) == "${HOME}"
+
+
+def test_strategic_merge_merges_maps_and_removes_null_values():
+    base = {"metadata": {"labels": {"a": "1", "b": "2"}}, "spec": {"replicas": 1}}
+    patch = {"metadata": {"labels": {"b": None, "c": "3"}}, "spec": {"replicas": 3}}
+
+    merged = strategic_merge(base, patch)
+
+    assert merged == {
+        "metadata": {"labels": {"a": "1", "c": "3"}},
+        "spec": {"replicas": 3},
+    }
+    assert base["metadata"]["labels"] == {"a": "1", "b": "2"}
+
+
+def test_strategic_merge_merges_containers_by_name():
+    base = {
+        "containers": [
+            {"name": "app", "image": "app:1"},
+            {"name": "proxy", "image": "proxy:1"},
+        ]
+    }
+    patch = {"containers": [{"name": "proxy", "image": "proxy:2"}]}
+
+    assert strategic_merge(base, patch) == {
+        "containers": [
+            {"name": "app", "image": "app:1"},
+            {"name": "proxy", "image": "proxy:2"},
+        ]
+    }
+
+
+def test_strategic_merge_merges_volume_mounts_by_mount_path():
+    base = {
+        "volumeMounts": [
+            {"name": "data", "mountPath": "/a"},
+            {"name": "data", "mountPath": "/b", "subPath": "b"},
+        ]
+    }
+    patch = {"volumeMounts": [{"name": "data", "mountPath": "/a", "readOnly": True}]}
+
+    assert strategic_merge(base, patch) == {
+        "volumeMounts": [
+            {"name": "data", "mountPath": "/a", "readOnly": True},
+            {"name": "data", "mountPath": "/b", "subPath": "b"},
+        ]
+    }
+
+
+def test_strategic_merge_merges_ports_by_container_port_or_port():
+    container = {"ports": [{"containerPort": 80}, {"containerPort": 443}]}
+    service = {"ports": [{"port": 80, "targetPort": 8080}]}
+
+    assert strategic_merge(
+        container, {"ports": [{"containerPort": 80, "name": "http"}]}
+    ) == {"ports": [{"containerPort": 80, "name": "http"}, {"containerPort": 443}]}
+    assert strategic_merge(service, {"ports": [{"port": 80, "targetPort": 9090}]}) == {
+        "ports": [{"port": 80, "targetPort": 9090}]
+    }
+
+
+def test_strategic_merge_deletes_and_appends_list_items():
+    base = {"env": [{"name": "A", "value": "1"}, {"name": "B", "value": "2"}]}
+    patch = {"env": [{"name": "A", "$patch": "delete"}, {"name": "C", "value": "3"}]}
+
+    assert strategic_merge(base, patch) == {
+        "env": [{"name": "B", "value": "2"}, {"name": "C", "value": "3"}]
+    }
+
+
+def test_strategic_merge_replaces_lists_without_merge_key():
+    base = {"args": ["--a"], "tolerations": [{"key": "a"}]}
+    patch = {"args": ["--b"], "tolerations": [{"key": "b"}]}
+
+    assert strategic_merge(base, patch) == patch
+
+
+def test_strategic_merge_fails_on_duplicate_merge_keys():
+    base = {"env": [{"name": "A", "value": "1"}, {"name": "A", "value": "2"}]}
+
+    with pytest.raises(Exception, match="Duplicate name 'A'"):
+        strategic_merge(base, {"env": [{"name": "A", "value": "3"}]})
+
+
+@pytest.fixture
+def overlay_tree(tmp_path):
+    base = tmp_path / "base"
+    base.mkdir()
+    (base / "deployment.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "metadata": {"name": "web"},
+                "spec": {
+                    "replicas": 1,
+                    "template": {
+                        "spec": {"containers": [{"name": "web", "image": "web:${TAG}"}]}
+                    },
+                },
+            }
+        )
+    )
+    for environment, tag in (("dev", "dev-1"), ("prod", "1.0")):
+        directory = tmp_path / "overlays" / environment
+        directory.mkdir(parents=True)
+        (directory / "overlay.yaml").write_text(
+            yaml.safe_dump(
+                {"variables": {"TAG": tag}, "deploy_queue_name": f"{environment}-q"}
+            )
+        )
+    (tmp_path / "overlays" / "prod" / "replicas.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "metadata": {"name": "web"},
+                "spec": {"replicas": 3},
+            }
+        )
+    )
+    return tmp_path
+
+
+def test_render_applies_variables_and_patches(overlay_tree):
+    overlays = load_overlays(overlay_tree / "overlays")
+    renderer = OverlayRenderer(overlay_tree / "base")
+
+    assert [o.name for o in overlays] == ["dev", "prod"]
+    assert overlays[1].deploy_queue_name == "prod-q"
+    dev, prod = (renderer.render_documents(o)[0] for o in overlays)
+    assert dev["spec"]["replicas"] == 1
+    assert dev["spec"]["template"]["spec"]["containers"][0]["image"] == "web:dev-1"
+    assert prod["spec"]["replicas"] == 3
+    assert prod["spec"]["template"]["spec"]["containers"][0]["image"] == "web:1.0"
+
+
+def test_render_is_deterministic_and_hashed(overlay_tree):
+    overlay = load_overlays(overlay_tree / "overlays", ["prod"])[0]
+
+    manifests, digest = OverlayRenderer(overlay_tree / "base").render(overlay)
+
+    assert (manifests, digest) == OverlayRenderer(overlay_tree / "base").render(overlay)
+    assert digest == hashlib.sha256(manifests.encode()).hexdigest()
+
+
+def test_render_fails_on_undefined_variable(overlay_tree):
+    renderer = OverlayRenderer(overlay_tree / "base")
+
+    with pytest.raises(Exception, match="TAG.*Deployment/web of overlay qa"):
+        renderer.render(Overlay("qa"))
+
+
+def test_render_fails_on_patch_without_base_document(overlay_tree):
+    patch = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "x"}}
+    overlay = Overlay("qa", variables={"TAG": "1"}, patches=[patch])
+
+    with pytest.raises(Exception, match="matches no base document"):
+        OverlayRenderer(overlay_tree / "base").render(overlay)
+
+
+def test_push_fails_when_environments_share_a_queue(overlay_tree):
+    (overlay_tree / "overlays" / "dev" / "overlay.yaml").write_text(
+        yaml.safe_dump({"variables": {"TAG": "dev-1"}})
+    )
+
+    with pytest.raises(Exception, match="dev, prod .* same queue prod-q"):
+        push_overlays_to_deploy_queue(
+            overlay_tree / "overlays",
+            deploy_queue_name="prod-q",
+            manifests_root=overlay_tree / "base",
+            validate=False,
+        )
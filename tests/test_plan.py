@@ -0,0 +1,65 @@
+from kube_pico_cd.plan import diff_objects, mask_secret_data, normalize
+from kube_pico_cd.pruning import BUILD_LABEL
+
+
+def test_normalize_drops_server_fields_and_build_label():
+    obj = {
+        "kind": "ConfigMap",
+        "metadata": {
+            "name": "a",
+            "uid": "1234",
+            "resourceVersion": "5",
+            "managedFields": [{}],
+            "labels": {BUILD_LABEL: "7"},
+        },
+        "data": {"a": "b"},
+        "status": {},
+    }
+
+    assert normalize(obj) == {
+        "kind": "ConfigMap",
+        "metadata": {"name": "a"},
+        "data": {"a": "b"},
+    }
+    assert obj["metadata"]["uid"] == "1234"
+
+
+def test_diff_objects_lists_changed_paths():
+    old = {"spec": {"replicas": 1, "ports": [{"port": 80}], "args": ["a"]}}
+    new = {"spec": {"replicas": 2, "ports": [{"port": 81}], "args": ["a", "b"]}}
+
+    assert diff_objects(old, new) == [
+        ("spec.args", ["a"], ["a", "b"]),
+        ("spec.ports[0].port", 80, 81),
+        ("spec.replicas", 1, 2),
+    ]
+
+
+def test_diff_objects_reports_added_and_removed_fields():
+    assert diff_objects({"a": 1}, {"b": 2}) == [("a", 1, None), ("b", None, 2)]
+    assert diff_objects({"a": [1]}, {"a": [1]}) == []
+
+
+def test_mask_secret_data_hides_values_but_shows_changed_keys():
+    old = {
+        "kind": "Secret",
+        "data": {"same": "czE=", "changed": "czE=", "gone": "eA=="},
+    }
+    new = {"kind": "Secret", "data": {"same": "czE=", "changed": "czI=", "new": "eQ=="}}
+
+    old_masked, new_masked = mask_secret_data(old, new)
+
+    assert diff_objects(old_masked, new_masked) == [
+        ("data.changed", "*** (before)", "*** (after)"),
+        ("data.gone", "***", None),
+        ("data.new", None, "***"),
+    ]
+    assert old_masked["data"]["same"] == new_masked["data"]["same"] == "***"
+    assert old["data"]["changed"] == "czE="
+
+
+def test_mask_secret_data_keeps_absent_fields_absent():
+    old_masked, new_masked = mask_secret_data({}, {"stringData": {"a": "secret"}})
+
+    assert old_masked == {}
+    assert new_masked == {"stringData": {"a": "***"}}
@@ -0,0 +1,135 @@
+from kube_pico_cd.pruning import (
+    OWNING_SET_LABEL,
+    PROTECTED_ANNOTATION,
+    Pruner,
+    stamp_documents,
+)
+
+
+class StubObjectList:
+    def __init__(self, items):
+        self.items = items
+
+    def to_dict(self):
+        return {"items": self.items}
+
+
+# Stands in for a resource of the dynamic client, serving the given objects
+class StubResource:
+    def __init__(self, group_version, kind, namespaced, items):
+        self.group_version = group_version
+        self.kind = kind
+        self.namespaced = namespaced
+        self.items = items
+        self.deleted = []
+
+    def get(self, namespace=None, label_selector=None):
+        assert label_selector == f"{OWNING_SET_LABEL}=app"
+        return StubObjectList(
+            [
+                item
+                for item in self.items
+                if namespace is None or item["metadata"].get("namespace") == namespace
+            ]
+        )
+
+    def delete(self, name, namespace, propagation_policy, dry_run):
+        self.deleted.append((name, namespace, dry_run))
+
+
+class StubResources:
+    def __init__(self, resources):
+        self.resources = resources
+
+    def get(self, api_version, kind):
+        return self.resources[(api_version, kind)]
+
+
+class StubDynamicClient:
+    def __init__(self, *resources):
+        self.resources = StubResources(
+            {(r.group_version, r.kind): r for r in resources}
+        )
+
+
+class StubLimiter:
+    maximum = 4
+
+
+class StubGovernor:
+    limiter = StubLimiter()
+
+    def call(self, kinds, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+def document(kind, name, namespace=None, api_version="v1", annotations=None):
+    metadata = {"name": name}
+    if namespace is not None:
+        metadata["namespace"] = namespace
+    if annotations is not None:
+        metadata["annotations"] = annotations
+    return {"apiVersion": api_version, "kind": kind, "metadata": metadata}
+
+
+def test_stamp_documents_labels_copies():
+    documents = [document("ConfigMap", "a")]
+
+    (stamped,) = stamp_documents(documents, "app", 7)
+
+    assert stamped["metadata"]["labels"] == {
+        OWNING_SET_LABEL: "app",
+        "kube-pico-cd/build": "7",
+    }
+    assert "labels" not in documents[0]["metadata"]
+
+
+def test_prune_deletes_owned_objects_missing_from_the_bundle():
+    config_maps = StubResource(
+        "v1",
+        "ConfigMap",
+        True,
+        [
+            document("ConfigMap", "kept", "ns"),
+            document("ConfigMap", "removed", "ns"),
+            document("ConfigMap", "kept", "other"),
+        ],
+    )
+    pruner = Pruner(StubDynamicClient(config_maps), StubGovernor(), "app", "ns")
+    previous = [document("ConfigMap", "kept", "other")]
+
+    stale = pruner.prune([document("ConfigMap", "kept")], previous)
+
+    assert [item["metadata"]["name"] for _, item in stale] == ["removed", "kept"]
+    assert sorted(config_maps.deleted) == [
+        ("kept", "other", None),
+        ("removed", "ns", None),
+    ]
+
+
+def test_prune_matches_cluster_scoped_objects_by_name():
+    namespaces = StubResource(
+        "v1",
+        "Namespace",
+        False,
+        [document("Namespace", "kept"), document("Namespace", "removed")],
+    )
+    pruner = Pruner(StubDynamicClient(namespaces), StubGovernor(), "app", "ns")
+
+    pruner.prune([document("Namespace", "kept")])
+
+    assert namespaces.deleted == [("removed", None, None)]
+
+
+def test_prune_keeps_protected_objects_and_honours_dry_run():
+    protected = document(
+        "ConfigMap", "protected", "ns", annotations={PROTECTED_ANNOTATION: "true"}
+    )
+    config_maps = StubResource(
+        "v1", "ConfigMap", True, [protected, document("ConfigMap", "removed", "ns")]
+    )
+    pruner = Pruner(StubDynamicClient(config_maps), StubGovernor(), "app", "ns")
+
+    pruner.prune([], [document("ConfigMap", "protected")], dry_run=True)
+
+    assert config_maps.deleted == [("removed", "ns", "All")]
@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+from kube_pico_cd import rate_limit
+from kube_pico_cd.rate_limit import AimdLimiter, TokenBucket
+
+
+# Replaces the clock of the rate limiters, sleeping advances it at once
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_token_bucket_allows_burst_then_refills_at_qps(clock):
+    bucket = TokenBucket(qps=20, burst=3)
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.now == 0
+
+    bucket.acquire()
+    bucket.acquire()
+    # two more tokens at 20 qps take 0.1s
+    assert clock.now == pytest.approx(0.1)
+
+
+def test_token_bucket_priority_takes_token_on_credit(clock):
+    bucket = TokenBucket(qps=1, burst=1)
+    bucket.acquire()
+
+    bucket.acquire(priority=True)
+
+    assert clock.now == 0
+    assert bucket.tokens == -1
+
+    # the next caller waits for the token taken on credit as well
+    bucket.acquire()
+    assert clock.now == pytest.approx(2)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.001)
+
+
+def limiter(initial=4, minimum=1, maximum=8):
+    return AimdLimiter(initial, minimum, maximum, latency_target=1.0)
+
+
+def test_limiter_grows_additively_on_success():
+    aimd = limiter(initial=4)
+
+    for _ in range(4):
+        aimd.on_success(0.1)
+
+    assert int(aimd.limit) == 4
+    assert aimd.limit == pytest.approx(4 + 4 * 0.25, rel=0.1)
+
+
+def test_limiter_success_without_latency_only_grows():
+    aimd = limiter(initial=4)
+
+    aimd.on_success()
+
+    assert aimd.limit > 4
+
+
+def test_limiter_shrinks_on_high_latency_and_throttling():
+    aimd = limiter(initial=8)
+
+    aimd.on_success(2.0)
+    assert aimd.limit == pytest.approx(8 * 0.9)
+
+    aimd.on_throttled()
+    assert aimd.limit == pytest.approx(8 * 0.9 * 0.5)
+
+
+def test_limiter_stays_within_bounds():
+    aimd = limiter(initial=2, minimum=1, maximum=3)
+
+    for _ in range(10):
+        aimd.on_throttled()
+    assert aimd.limit == 1
+
+    for _ in range(100):
+        aimd.on_success(0.1)
+    assert aimd.limit == 3
+
+
+def test_limiter_admits_priority_waiters_first():
+    aimd = limiter(initial=1)
+    aimd.acquire()
+    order = []
+
+    def acquire(name, priority):
+        aimd.acquire(priority)
+        order.append(name)
+        aimd.release()
+
+    normal = threading.Thread(target=acquire, args=("normal", False))
+    normal.start()
+    wait_until(lambda: aimd.waiting == 1)
+    prioritized = threading.Thread(target=acquire, args=("priority", True))
+    prioritized.start()
+    wait_until(lambda: aimd.waiting == 2 and aimd.priority_waiting == 1)
+
+    aimd.release()
+    normal.join(5)
+    prioritized.join(5)
+
+    assert order == ["priority", "normal"]
@@ -0,0 +1,49 @@
+from kube_pico_cd.rollout import is_ready
+
+
+def workload(spec=None, status=None, generation=2, observed_generation=2):
+    return {
+        "metadata": {"name": "app", "generation": generation},
+        "spec": spec or {},
+        "status": dict(status or {}, observedGeneration=observed_generation),
+    }
+
+
+def test_deployment_is_ready_when_all_replicas_are_updated_and_available():
+    status = {"replicas": 3, "updatedReplicas": 3, "availableReplicas": 3}
+
+    assert is_ready("Deployment", workload({"replicas": 3}, status))
+
+
+def test_deployment_is_not_ready_while_old_replicas_remain():
+    status = {"replicas": 4, "updatedReplicas": 3, "availableReplicas": 3}
+
+    assert not is_ready("Deployment", workload({"replicas": 3}, status))
+
+
+def test_deployment_is_not_ready_before_its_generation_is_observed():
+    status = {"replicas": 3, "updatedReplicas": 3, "availableReplicas": 3}
+
+    assert not is_ready(
+        "Deployment", workload({"replicas": 3}, status, observed_generation=1)
+    )
+
+
+def test_stateful_set_waits_for_updated_replicas_of_rolling_updates():
+    status = {"readyReplicas": 2, "updatedReplicas": 1}
+    on_delete = {"replicas": 2, "updateStrategy": {"type": "OnDelete"}}
+
+    assert not is_ready("StatefulSet", workload({"replicas": 2}, status))
+    assert is_ready("StatefulSet", workload(on_delete, status))
+
+
+def test_daemon_set_is_ready_when_all_scheduled_pods_are_updated_and_available():
+    status = {
+        "desiredNumberScheduled": 3,
+        "updatedNumberScheduled": 3,
+        "numberAvailable": 2,
+    }
+
+    assert not is_ready("DaemonSet", workload(status=status))
+    status["numberAvailable"] = 3
+    assert is_ready("DaemonSet", workload(status=status))
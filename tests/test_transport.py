@@ -0,0 +1,81 @@
+import time
+
+from kube_pico_cd.transport import SpoolTransport
+
+
+def test_messages_are_received_in_send_order(tmp_path):
+    transport = SpoolTransport(tmp_path)
+    for body in ("first", "second", "third"):
+        transport.send(body)
+
+    messages = transport.receive_batch(max_messages=2, wait_seconds=0)
+
+    assert [m.body for m in messages] == ["first", "second"]
+    assert [m.body for m in transport.receive_batch(wait_seconds=0)] == ["third"]
+
+
+def test_received_message_is_invisible_until_acknowledged(tmp_path):
+    transport = SpoolTransport(tmp_path)
+    transport.send("hello")
+
+    (message,) = transport.receive_batch(wait_seconds=0)
+    assert transport.receive_batch(wait_seconds=0) == []
+
+    transport.ack(message)
+    assert list((tmp_path / "inflight").iterdir()) == []
+    assert list((tmp_path / "new").iterdir()) == []
+
+
+def test_message_is_redelivered_after_visibility_timeout(tmp_path):
+    transport = SpoolTransport(tmp_path, visibility_timeout=0.2)
+    transport.send("hello")
+    (message,) = transport.receive_batch(wait_seconds=0)
+
+    time.sleep(0.3)
+
+    (redelivered,) = transport.receive_batch(wait_seconds=0)
+    assert redelivered.body == "hello"
+    assert redelivered.message_id == message.message_id
+
+
+def test_extend_visibility_delays_redelivery(tmp_path):
+    transport = SpoolTransport(tmp_path, visibility_timeout=0.2)
+    transport.send("hello")
+    (message,) = transport.receive_batch(wait_seconds=0)
+
+    transport.extend_visibility(message, 60)
+    time.sleep(0.3)
+
+    assert transport.receive_batch(wait_seconds=0) == []
+
+
+def test_zero_visibility_releases_message(tmp_path):
+    transport = SpoolTransport(tmp_path)
+    transport.send("hello")
+    (message,) = transport.receive_batch(wait_seconds=0)
+
+    transport.extend_visibility(message, 0)
+
+    assert [m.body for m in transport.receive_batch(wait_seconds=0)] == ["hello"]
+
+
+def test_release_of_acknowledged_message_is_ignored(tmp_path):
+    transport = SpoolTransport(tmp_path)
+    transport.send("hello")
+    (message,) = transport.receive_batch(wait_seconds=0)
+    transport.ack(message)
+
+    transport.extend_visibility(message, 0)
+    transport.extend_visibility(message, 60)
+
+    assert transport.receive_batch(wait_seconds=0) == []
+
+
+def test_receive_waits_for_a_message_from_another_sender(tmp_path):
+    transport = SpoolTransport(tmp_path)
+    sender = SpoolTransport(tmp_path)
+
+    assert transport.receive_batch(wait_seconds=0.1) == []
+    sender.send("late")
+
+    assert [m.body for m in transport.receive_batch(wait_seconds=1)] == ["late"]
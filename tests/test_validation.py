@@ -0,0 +1,77 @@
+import pytest
+import yaml
+from dynaconf import Dynaconf
+from kube_pico_cd.config import settings_path
+from kube_pico_cd.validation import SchemaValidator, crd_schema_file_name
+
+
+def crd(group, required_field):
+    return {
+        "apiVersion": "apiextensions.k8s.io/v1",
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": f"widgets.{group}"},
+        "spec": {
+            "group": group,
+            "names": {"kind": "Widget"},
+            "versions": [
+                {
+                    "name": "v1",
+                    "schema": {
+                        "openAPIV3Schema": {
+                            "type": "object",
+                            "required": [required_field],
+                        }
+                    },
+                }
+            ],
+        },
+    }
+
+
+def widget(group, **fields):
+    return dict(
+        {"apiVersion": f"{group}/v1", "kind": "Widget", "metadata": {"name": "w"}},
+        **fields,
+    )
+
+
+@pytest.fixture
+def validator(tmp_path):
+    settings = Dynaconf(settings_files=[settings_path])
+    # An empty local schema location publishes no schemas
+    (tmp_path / "schemas").mkdir()
+    settings.set("schema_location", str(tmp_path / "schemas"))
+    settings.set("schema_cache_dir", str(tmp_path / "cache"))
+    settings.set("validation_workers", 1)
+    crd_file = tmp_path / "crds.yaml"
+    crd_file.write_text(yaml.safe_dump(crd("widgets.other.io", "size")))
+    return SchemaValidator(settings, crd_paths=[crd_file])
+
+
+def test_crd_schema_file_name_keeps_full_group():
+    assert crd_schema_file_name("widgets.example.com/v1", "Widget") == (
+        "widget-widgets.example.com-v1.json"
+    )
+
+
+def test_crds_sharing_first_group_segment_keep_their_own_schema(validator):
+    documents = [
+        crd("widgets.example.com", "color"),
+        widget("widgets.example.com", color="red"),
+        widget("widgets.other.io", size=1),
+    ]
+
+    assert validator.validate(documents) == []
+    errors = validator.validate(
+        [crd("widgets.example.com", "color"), widget("widgets.example.com", size=1)]
+    )
+    assert len(errors) == 1 and "'color' is a required property" in errors[0]
+
+
+def test_crd_removed_from_bundle_is_not_used(validator):
+    validator.validate(
+        [crd("widgets.example.com", "color"), widget("widgets.example.com")]
+    )
+
+    assert validator.validate([widget("widgets.example.com")]) == []
+    assert not (validator.cache_dir / "crds").exists()